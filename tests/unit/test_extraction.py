@@ -12,7 +12,8 @@ sys.path.append('../../')
 sys.path.append('..')
 
 from testing_utils import *
-from tinytroupe.extraction import ArtifactExporter, Normalizer
+from tinytroupe.extraction import ArtifactExporter, Normalizer, ResultsReducer
+from tinytroupe.agent import TinyPerson
 from tinytroupe import utils
 
 @pytest.fixture
@@ -122,3 +123,33 @@ def test_normalizer():
         assert next_cache_size >= init_cache_size, "The cache size should not decrease after normalizing a new concept."
     
     
+
+
+def test_reducer(setup):
+    agent = TinyPerson("Reducer Tester")
+    other = TinyPerson("Reducer Peer")
+
+    agent.episodic_memory.store({'role': 'user', 'content': {'stimuli': [{'type': 'CONVERSATION', 'content': 'Hello!', 'source': other.name}]}, 'simulation_timestamp': None})
+    agent.episodic_memory.store({'role': 'assistant', 'content': {'action': {'type': 'TALK', 'content': 'Hi there!', 'target': other.name}}, 'simulation_timestamp': None})
+    agent.episodic_memory.store({'role': 'assistant', 'content': {'action': {'type': 'THINK', 'content': 'Nice person.', 'target': ''}}, 'simulation_timestamp': None})
+
+    # rules returning dicts
+    reducer = ResultsReducer()
+    reducer.add_reduction_rule("CONVERSATION", lambda source_agent, content, **kwargs: {"author": source_agent.name, "content": content})
+    reducer.add_reduction_rule("TALK", lambda focus_agent, target_agent, content, **kwargs: {"author": focus_agent.name, "content": content, "target": target_agent.name})
+
+    df = reducer.reduce_agent_to_dataframe(agent)
+    assert list(df.columns) == ["author", "content", "target"], "The columns should follow the order in which they were first produced."
+    assert list(df["author"]) == [other.name, agent.name], "The authors should have been extracted in order."
+    assert df["target"].isna()[0] and df["target"][1] == other.name, "Missing values should be left empty."
+
+    # legacy rules returning tuples
+    legacy_reducer = ResultsReducer()
+    legacy_reducer.add_reduction_rule("CONVERSATION", lambda source_agent, content, **kwargs: (source_agent.name, content))
+    legacy_reducer.add_reduction_rule("TALK", lambda focus_agent, content, **kwargs: (focus_agent.name, content))
+
+    assert legacy_reducer.reduce_agent(agent) == [(other.name, "Hello!"), (agent.name, "Hi there!")], "Tuples should be returned as they are."
+
+    df = legacy_reducer.reduce_agent_to_dataframe(agent, column_names=["author", "content"])
+    assert list(df.columns) == ["author", "content"], "The given column names should be used."
+    assert list(df["content"]) == ["Hello!", "Hi there!"], "The contents should have been extracted in order."
@@ -1,5 +1,6 @@
 import pytest
 import os
+import asyncio
 
 import sys
 sys.path.append('../../tinytroupe/')
@@ -29,4 +30,35 @@ def test_generate_person(setup):
 
     assert proposition_holds(f"The following is an acceptable short description for someone working in banking: '{minibio}'"), f"Proposition is false according to the LLM."
 
-    
+def test_generate_persons_async(setup):
+    factory = TinyPersonFactory("A group of friends who like to play board games on weekends.")
+
+    persons = asyncio.run(factory.generate_persons_async(3, max_concurrency=3))
+
+    assert len(persons) == 3, "Three persons should have been generated."
+    assert all(person is not None for person in persons), "All persons should have been generated."
+    assert len(set(person.name for person in persons)) == 3, "The generated persons should have unique names."
+
+def test_generate_persons_batched(setup):
+    factory = TinyPersonFactory("A group of friends who like to play board games on weekends.")
+
+    persons = factory.generate_persons_batched(4, batch_size=2)
+
+    assert len(persons) == 4, "Four persons should have been generated."
+    assert len(set(person.name for person in persons)) == 4, "The generated persons should have unique names."
+
+def test_generate_persons_from_factories_async(setup):
+    persons = asyncio.run(TinyPersonFactory.generate_persons_from_factories_async(3, "Latin American professionals between 20 and 40 years old."))
+
+    assert len(persons) == 3, "One person should have been generated for each factory."
+    assert all(person is not None for person in persons), "All persons should have been generated."
+    assert len(set(person.name for person in persons)) == 3, "The generated persons should have unique names."
+
+def test_generate_persons(setup):
+    factory = TinyPersonFactory("A group of friends who like to play board games on weekends.")
+
+    persons = factory.generate_persons(3, max_workers=3)
+
+    assert len(persons) == 3, "Three persons should have been generated."
+    assert all(person is not None for person in persons), "All persons should have been generated."
+    assert len(set(person.name for person in persons)) == 3, "The generated persons should have unique names."
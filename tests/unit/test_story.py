@@ -1,4 +1,5 @@
 import pytest
+import asyncio
 import logging
 logger = logging.getLogger("tinytroupe")
 
@@ -67,3 +68,48 @@ def test_story_continuation(setup, focus_group_world):
 
     assert proposition_holds(f"The following two text blocks could belong to the same story: \n BLOCK 1: '{story_beginning}' and \n BLOCK 2: '{continuation}'"), f"Proposition is false according to the LLM."
 
+
+def test_story_cache_generations(setup, focus_group_world):
+    world = focus_group_world
+
+    # identical requests should reuse the same generation
+    start_1 = TinyStory(world, cache_generations=True).start_story(requirements="Start a story about a quiet afternoon.")
+    start_2 = TinyStory(world, cache_generations=True).start_story(requirements="Start a story about a quiet afternoon.")
+
+    assert start_1 == start_2, "Identical requests should produce the same cached story start."
+
+def test_story_continuation_batch(setup, focus_group_world):
+    world = focus_group_world
+
+    world.broadcast("Discuss what you would do if you found a lost wallet on the street.")
+    world.run(1)
+
+    story = TinyStory(world)
+    story_length = len(story.current_story)
+
+    continuations = story.continue_story_batch([{"requirements": "Continue the story in a happy way."},
+                                                {"requirements": "Continue the story in a sad way.", "include_plot_twist": True}])
+
+    print("Story continuations: ", continuations)
+
+    assert len(continuations) == 2, "There should be one continuation per variant."
+    for continuation in continuations:
+        assert continuation is not None and len(continuation) > 0, "Continuations should not be empty."
+        assert continuation not in story.current_story, "Proposed continuations should not be added to the story."
+
+def test_story_continuation_many(setup, focus_group_world):
+    world = focus_group_world
+
+    world.broadcast("Discuss what you would do if you won the lottery.")
+    world.run(1)
+
+    story = TinyStory(world)
+
+    variants = [{"requirements": f"Continue the story, focusing on what happens {when}."} for when in ["the next day", "a year later", "ten years later"]]
+    continuations = asyncio.run(story.continue_story_many(variants, max_concurrency=2, requests_per_minute=60, tokens_per_minute=100000))
+
+    print("Story continuations: ", continuations)
+
+    assert len(continuations) == len(variants), "There should be one continuation per variant."
+    for continuation in continuations:
+        assert continuation is not None and len(continuation) > 0, "Continuations should not be empty."
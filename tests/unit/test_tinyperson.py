@@ -37,6 +37,31 @@ def test_listen(setup):
         assert agent.episodic_memory.retrieve_all()[-1]['content']['stimuli'][0]['type'] == 'CONVERSATION', f"{agent.name} should have the last message as a 'CONVERSATION' stimulus."
         assert agent.episodic_memory.retrieve_all()[-1]['content']['stimuli'][0]['content'] == 'Hello, how are you?', f"{agent.name} should have the last message with the correct content."
 
+def test_listen_batch(setup):
+    # test that the agent listens to several speech stimuli at once, in a single observation
+    for agent in [create_oscar_the_architect(), create_lisa_the_data_scientist()]:
+        agent.listen_batch([("Hello, how are you?", None), ("Are you there?", None)])
+
+        stimuli = agent.episodic_memory.retrieve_all()[-1]['content']['stimuli']
+        assert agent.episodic_memory.retrieve_all()[-1]['role'] == 'user', f"{agent.name} should have the last message as 'user'."
+        assert len(stimuli) == 2, f"{agent.name} should have both stimuli in its last message."
+        assert all(stimulus['type'] == 'CONVERSATION' for stimulus in stimuli), f"{agent.name} should have only 'CONVERSATION' stimuli."
+        assert [stimulus['content'] for stimulus in stimuli] == ["Hello, how are you?", "Are you there?"], f"{agent.name} should have the stimuli in the order they were given."
+
+def test_pretty_current_interactions(setup):
+    # test that the pretty interactions are reused while the memory does not change, but reflect any new messages
+    for agent in [create_oscar_the_architect(), create_lisa_the_data_scientist()]:
+        agent.listen("Hello, how are you?")
+        first = agent.pretty_current_interactions()
+        assert "Hello, how are you?" in first, f"{agent.name} should show the message it listened to."
+        assert agent.pretty_current_interactions() is first, f"{agent.name} should reuse the pretty interactions while its memory does not change."
+
+        agent.listen("Are you there?")
+        second = agent.pretty_current_interactions()
+        assert "Are you there?" in second, f"{agent.name} should show the new message it listened to."
+        last = agent.pretty_current_interactions(last_n=1, include_omission_info=False)
+        assert "Are you there?" in last and "Hello, how are you?" not in last, f"{agent.name} should take the arguments into account."
+
 def test_define(setup):
     # test that the agent defines a value to its configuration and resets its prompt
     for agent in [create_oscar_the_architect(), create_lisa_the_data_scientist()]:
@@ -1,5 +1,6 @@
 import pytest
 import logging
+import json
 logger = logging.getLogger("tinytroupe")
 
 import sys
@@ -8,7 +9,7 @@ sys.path.append('../../')
 sys.path.append('..')
 
 from tinytroupe.examples import create_lisa_the_data_scientist, create_oscar_the_architect, create_marcos_the_physician
-from tinytroupe.environment import TinyWorld
+from tinytroupe.environment import TinyWorld, TinySocialNetwork
 from testing_utils import *
 
 def test_run(setup, focus_group_world):
@@ -76,3 +77,134 @@ def test_decode_complete_state(setup, focus_group_world):
     assert len(world_2.agents) == n_agents_1, "The world should have the same number of agents."
 
 
+def test_make_everyone_accessible(setup, focus_group_world):
+    world = focus_group_world
+
+    world.make_everyone_accessible()
+
+    for agent in world.agents:
+        others = [other for other in world.agents if other is not agent]
+        assert agent._accessible_agents == others, f"{agent.name} should have access to all other agents, and only them."
+        assert [a["name"] for a in agent._configuration["currently_accessible_agents"]] == [other.name for other in others], \
+            f"{agent.name} should have all other agents in its configuration."
+
+    # doing it again should not duplicate anything
+    world.make_everyone_accessible()
+    for agent in world.agents:
+        assert len(agent._accessible_agents) == len(world.agents) - 1, f"{agent.name} should not have duplicated accessible agents."
+
+def test_social_network_relations(setup):
+    lisa, oscar, marcos = create_lisa_the_data_scientist(), create_oscar_the_architect(), create_marcos_the_physician()
+
+    network = TinySocialNetwork("Social network")
+    network.add_relation(lisa, oscar, name="colleagues")
+    network.add_relation(oscar, marcos, name="friends")
+    network.add_relation(lisa, oscar, name="colleagues") # duplicates are ignored
+
+    assert len(network.relations["colleagues"]) == 1, "Duplicated relations should not be added."
+
+    # relations are undirected
+    assert network.is_in_relation_with(lisa, oscar), "Lisa and Oscar should be in a relation."
+    assert network.is_in_relation_with(oscar, lisa), "Oscar and Lisa should be in a relation."
+    assert network.is_in_relation_with(oscar, lisa, relation_name="colleagues"), "Oscar and Lisa should be colleagues."
+    assert not network.is_in_relation_with(oscar, lisa, relation_name="friends"), "Oscar and Lisa should not be friends."
+    assert not network.is_in_relation_with(lisa, marcos), "Lisa and Marcos should not be in any relation."
+    assert not network.is_in_relation_with(lisa, None), "No agent should be in a relation with a missing agent."
+
+def test_encode_decode_social_network(setup):
+    lisa, oscar = create_lisa_the_data_scientist(), create_oscar_the_architect()
+
+    network = TinySocialNetwork("Social network")
+    network.add_agents([lisa, oscar])
+    network.add_relation(lisa, oscar, name="colleagues")
+
+    # relations are encoded by agent names, so that the state can be serialized
+    state = network.encode_complete_state()
+    assert state["relations"] == {"colleagues": [[lisa.name, oscar.name]]}, "Relations should be encoded by agent names."
+    json.dumps(state) # must not fail
+
+    # screw up the network
+    network.relations = {}
+    network._pair_to_relations = {}
+
+    network.decode_complete_state(state)
+    assert network.relations["colleagues"] == [(lisa, oscar)], "Relations should refer to the actual agents again."
+    assert network.is_in_relation_with(oscar, lisa, relation_name="colleagues"), "The relations index should be restored."
+
+
+def test_agent_tiers(setup, focus_group_world):
+    world = focus_group_world
+    lisa, oscar, marcos = world.agents
+
+    lisa.tier = TinyPerson.TIER_BACKGROUND
+    oscar.tier = TinyPerson.TIER_REACTIVE
+    marcos.tier = TinyPerson.TIER_BACKGROUND
+
+    # nobody is active and there is nothing to react to, so no agent should act
+    actions = world.run(1, return_actions=True)
+    assert actions == [{agent.name: [] for agent in world.agents}], "Background and unstimulated reactive agents should not act."
+
+    # talking directly to a background agent brings it out of the background, so that it can respond
+    world._handle_actions(oscar, [{"type": "TALK", "content": "Hi Lisa!", "target": lisa.name}])
+    assert lisa.tier == TinyPerson.TIER_REACTIVE, "Lisa should have been promoted, since Oscar talked to her."
+    assert lisa._has_new_stimuli, "Lisa should have something to react to."
+    assert marcos.tier == TinyPerson.TIER_BACKGROUND, "Marcos should remain in the background."
+
+    assert lisa.promote().tier == TinyPerson.TIER_ACTIVE, "Lisa should be promoted to active."
+    assert lisa.promote().tier == TinyPerson.TIER_ACTIVE, "Active is the highest tier."
+    assert marcos.demote().tier == TinyPerson.TIER_BACKGROUND, "Background is the lowest tier."
+
+def test_stagger_agents(setup, focus_group_world):
+    world = focus_group_world
+    lisa, oscar, marcos = world.agents
+
+    # Lisa acts at every step, while Oscar and Marcos take turns
+    oscar.stagger_period = 2
+    marcos.stagger_period = 2
+
+    due_over_time = []
+    for tick in range(4):
+        world._tick = tick
+        due_over_time.append(world._agents_due())
+
+    assert due_over_time == [[lisa, oscar], [lisa, marcos], [lisa, oscar], [lisa, marcos]], "Agents with the same period should take turns."
+
+    # the schedule follows changes in the agents
+    world.remove_agent(oscar)
+    world._tick = 4
+    assert world._agents_due() == [lisa, marcos], "Marcos should be due, since he no longer shares his turns with Oscar."
+
+def test_social_network_batch_messages(setup):
+    lisa, oscar, marcos = create_lisa_the_data_scientist(), create_oscar_the_architect(), create_marcos_the_physician()
+
+    network = TinySocialNetwork("Social network", batch_messages=True)
+    assert network.batch_messages, "The social network should batch messages."
+
+    network.add_agents([lisa, oscar, marcos])
+    network.add_relation(lisa, marcos, name="colleagues")
+    network.add_relation(oscar, marcos, name="friends")
+
+    events = []
+
+    # agents act without the LLM: Lisa and Oscar talk to Marcos, who stays quiet
+    def scripted_act(agent, actions):
+        def act(return_actions=False, **kwargs):
+            events.append(("act", agent.name))
+            agent._actions_buffer = list(actions)
+            return actions if return_actions else None
+        return act
+
+    lisa.act = scripted_act(lisa, [{"type": "TALK", "content": "Hi Marcos!", "target": marcos.name}])
+    oscar.act = scripted_act(oscar, [{"type": "TALK", "content": "Hello Marcos!", "target": marcos.name}])
+    marcos.act = scripted_act(marcos, [])
+
+    marcos.listen = lambda *args, **kwargs: events.append(("listen", marcos.name))
+    marcos.listen_batch = lambda messages, **kwargs: events.append(("listen_batch", [(speech, source.name) for speech, source in messages]))
+
+    network._step()
+
+    # all the messages are delivered together, only after every agent acted
+    assert ("listen", marcos.name) not in events, "Messages should not be delivered one at a time."
+    assert events[-1] == ("listen_batch", [("Hi Marcos!", lisa.name), ("Hello Marcos!", oscar.name)]), \
+        "Marcos should get both messages at once, at the end of the step."
+    assert [event for event in events if event[0] == "act"] == [("act", lisa.name), ("act", oscar.name), ("act", marcos.name)]
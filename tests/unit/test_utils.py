@@ -1,4 +1,7 @@
 import pytest
+import re
+import json
+import time
 from unittest.mock import MagicMock
 
 import sys
@@ -7,8 +10,9 @@ sys.path.append('../../')
 sys.path.append('..')
 
 
-from tinytroupe.utils import name_or_empty, extract_json, repeat_on_error
+from tinytroupe.utils import name_or_empty, extract_json, extract_code_block, repeat_on_error, compress_interactions, json_dumps, json_loads, custom_hash, break_text_at_length
 from testing_utils import *
+import tinytroupe.utils
 
 def test_extract_json():
     # Test with a simple JSON string
@@ -26,6 +30,21 @@ def test_extract_json():
     result = extract_json(text)
     assert result == {"key": "'value'"}
 
+    # Test with invalid escape sequences
+    text = 'Some text before {"key": "it\\\'s"} some text after'
+    result = extract_json(text)
+    assert result == {"key": "it's"}
+
+    # Test with escaped backslashes, which must be kept
+    text = 'Some text before {"key": "C:\\\\"} some text after'
+    result = extract_json(text)
+    assert result == {"key": "C:\\"}
+
+    # Test with braces in the text after the JSON
+    text = 'Some text before {"key": "value"} some text after, with {braces}'
+    result = extract_json(text)
+    assert result == {"key": "value"}
+
     # Test with invalid JSON
     text = 'Some text before {"key": "value",} some text after'
     result = extract_json(text)
@@ -37,6 +56,19 @@ def test_extract_json():
     assert result == {}
 
 
+def test_extract_code_block():
+    # Test with text around the code block
+    text = 'Here is the code:\n```python\nprint("Hello")\n```\nHope it helps!'
+    assert extract_code_block(text) == '```python\nprint("Hello")\n```'
+
+    # Test with several code blocks, which are all kept
+    text = 'First:\n```\na = 1\n```\nSecond:\n```\nb = 2\n```\nDone.'
+    assert extract_code_block(text) == '```\na = 1\n```\nSecond:\n```\nb = 2\n```'
+
+    # Test with no code block
+    text = 'No code here.'
+    assert extract_code_block(text) == text
+
 def test_name_or_empty():
     class MockEntity:
         def __init__(self, name):
@@ -85,6 +117,117 @@ def test_repeat_on_error():
         decorated_function()
     assert dummy_function.call_count == 1
 
+def test_repeat_on_error_with_backoff(monkeypatch):
+    class DummyException(Exception):
+        pass
+
+    waits = []
+    monkeypatch.setattr(time, "sleep", lambda seconds: waits.append(seconds))
+
+    # Test that the waiting times grow exponentially, within the randomization bounds
+    dummy_function = MagicMock(side_effect=[DummyException(), DummyException(), DummyException(), "done"])
+    @repeat_on_error(retries=4, exceptions=[DummyException], waiting_time=1.0, exponential_backoff_factor=2.0, max_waiting_time=3.0)
+    def decorated_function():
+        return dummy_function()
+    assert decorated_function() == "done"
+    assert len(waits) == 3
+    assert 0.5 <= waits[0] <= 1.5
+    assert 1.0 <= waits[1] <= 3.0
+    assert 1.5 <= waits[2] <= 4.5 # capped at 3 seconds, before randomization
+
+    # Test that a Retry-After header is honored
+    class DummyHTTPException(DummyException):
+        def __init__(self):
+            self.response = MagicMock(headers={"retry-after": "7"})
+
+    waits.clear()
+    dummy_function = MagicMock(side_effect=[DummyHTTPException(), "done"])
+    @repeat_on_error(retries=2, exceptions=[DummyException])
+    def decorated_function():
+        return dummy_function()
+    assert decorated_function() == "done"
+    assert waits == [7.0]
+
+    # Test that no retry is attempted past the timeout
+    waits.clear()
+    dummy_function = MagicMock(side_effect=DummyException())
+    @repeat_on_error(retries=5, exceptions=[DummyException], waiting_time=10.0, timeout=5.0)
+    def decorated_function():
+        dummy_function()
+    with pytest.raises(DummyException):
+        decorated_function()
+    assert dummy_function.call_count == 1
+    assert waits == []
+
+def test_compress_interactions(monkeypatch):
+    # Test with a text that fits the budget, which is not even tokenized
+    text = "Oscar --> Lisa: [TALK] Hello!"
+    assert compress_interactions(text, model="gpt-4o", max_tokens=4096) == text
+    assert compress_interactions(text, model="gpt-4o", max_tokens=None) == text
+
+    # The actual encodings might need to be downloaded, so words and whitespace stand in for tokens
+    class WordEncoding:
+        def encode(self, text, **kwargs):
+            return re.findall(r"\S+|\s+", text)
+
+        def decode(self, tokens):
+            return "".join(tokens)
+
+    monkeypatch.setattr(tinytroupe.utils, "_encoding_for_model", lambda model: WordEncoding())
+
+    # Test with a text that is over the budget, which should keep the most recent interactions
+    text = "\n".join([f"Oscar --> Lisa: [TALK] This is message number {i}." for i in range(1000)])
+    result = compress_interactions(text, model="gpt-4o", max_tokens=100)
+    assert len(result) < len(text)
+    assert result.endswith("This is message number 999.")
+    assert "This is message number 0." not in result
+
+    # the kept interactions start at a line boundary
+    assert result.startswith("(...)\nOscar --> Lisa: [TALK] This is message number ")
+    assert all(line.startswith("Oscar --> Lisa: [TALK]") for line in result.split("\n")[1:])
+
+    # Test with an unknown method
+    with pytest.raises(ValueError):
+        compress_interactions(text, model="gpt-4o", max_tokens=100, method="unknown")
+
+def test_json_dumps_and_loads():
+    obj = {"b": [1, 2.5, None], "a": {"text": "Olá, 世界", "flag": True}}
+
+    # Test that keys are sorted only if requested, and that the output is compact
+    assert json_dumps(obj, sort_keys=True) == '{"a":{"flag":true,"text":"Olá, 世界"},"b":[1,2.5,null]}'
+    assert json_dumps(obj).startswith('{"b":')
+
+    # Test the round trip
+    assert json_loads(json_dumps(obj)) == obj
+
+    # Test with values that are not JSON serializable, which should be converted to strings
+    class Custom:
+        def __str__(self):
+            return "custom"
+    assert json_dumps({"value": Custom()}) == '{"value":"custom"}'
+
 # TODO
 #def test_json_serializer():
-    
\ No newline at end of file
+    
+def test_custom_hash():
+    # equal objects always get the same hash
+    assert custom_hash({"name": "Lisa", "age": 28}) == custom_hash({"name": "Lisa", "age": 28})
+    assert custom_hash(("a", 1, [2, 3])) == custom_hash(("a", 1, [2, 3]))
+
+    # different objects get different hashes
+    assert custom_hash({"name": "Lisa", "age": 28}) != custom_hash({"name": "Lisa", "age": 29})
+    assert custom_hash("1") != custom_hash("2")
+
+    # hashes are hex strings
+    int(custom_hash("something"), 16)
+
+def test_break_text_at_length():
+    assert break_text_at_length("A short text.", max_length=100) == "A short text."
+    assert break_text_at_length("A longer text.", max_length=8) == "A longer (...)"
+    assert break_text_at_length("Any text.") == "Any text."
+
+    # dicts are rendered as JSON, and broken in the same way
+    d = {"name": "Lisa", "interests": ["data science", "music"] * 50}
+    assert break_text_at_length(d) == json.dumps(d, indent=4)
+    assert break_text_at_length(d, max_length=10000) == json.dumps(d, indent=4)
+    assert break_text_at_length(d, max_length=30) == json.dumps(d, indent=4)[:30] + " (...)"
@@ -28,6 +28,7 @@ from tinytroupe.control import transactional
 from tinytroupe.control import current_simulation
 from rich import print
 import copy
+import functools
 from tinytroupe.utils import JsonSerializableRegistry
 
 from typing import Any, TypeVar, Union
@@ -47,20 +48,21 @@ default["max_content_display_length"] = config["OpenAI"].getint("MAX_CONTENT_DIS
 
 
 ## LLaMa-Index configs ########################################################
-#from llama_index.embeddings.huggingface import HuggingFaceEmbedding
-from llama_index.embeddings.openai import OpenAIEmbedding
-from llama_index.core import Settings, VectorStoreIndex, SimpleDirectoryReader
-from llama_index.readers.web import SimpleWebPageReader
+# LLaMa-Index takes longer to import than everything else together, and is only needed for the documents
+# of the semantic memory, so it is only imported (and configured) once some documents are actually added.
+@functools.lru_cache(maxsize=None)
+def _setup_llama_index():
+    #from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+    from llama_index.embeddings.openai import OpenAIEmbedding
+    from llama_index.core import Settings
 
+    # this will be cached locally by llama-index, in a OS-dependend location
 
-# this will be cached locally by llama-index, in a OS-dependend location
+    ##Settings.embed_model = HuggingFaceEmbedding(
+    ##    model_name="BAAI/bge-small-en-v1.5"
+    ##)
 
-##Settings.embed_model = HuggingFaceEmbedding(
-##    model_name="BAAI/bge-small-en-v1.5"
-##)
-
-llmaindex_openai_embed_model = OpenAIEmbedding(model=default["embedding_model"], embed_batch_size=10)
-Settings.embed_model = llmaindex_openai_embed_model
+    Settings.embed_model = OpenAIEmbedding(model=default["embedding_model"], embed_batch_size=10)
 ###############################################################################
 
 
@@ -81,6 +83,16 @@ class TinyPerson(JsonSerializableRegistry):
 
     PP_TEXT_WIDTH = 100
 
+    # The simulation tiers of agents, from the cheapest to the most expensive to simulate. Active agents reason through the LLM
+    # whenever they act, reactive agents only do so in response to new stimuli, and background agents never do.
+    TIER_BACKGROUND = "background"
+    TIER_REACTIVE = "reactive"
+    TIER_ACTIVE = "active"
+    TIERS = [TIER_BACKGROUND, TIER_REACTIVE, TIER_ACTIVE]
+
+    # The stimuli types that reactive agents respond to.
+    REACTIVE_STIMULI_TYPES = ["CONVERSATION", "SOCIAL", "VISUAL"]
+
     serializable_attributes = ["name", "episodic_memory", "semantic_memory", "_mental_faculties", "_configuration"]
 
     # A dict of all agents instantiated so far.
@@ -154,6 +166,18 @@ class TinyPerson(JsonSerializableRegistry):
         # saving these communications to another output form later (e.g., caching)
         self._displayed_communications_buffer = []
 
+        # how expensive this agent is to simulate, see TinyPerson.TIERS
+        self.tier = TinyPerson.TIER_ACTIVE
+
+        # whether the agent perceived stimuli it should react to since it last acted
+        self._has_new_stimuli = False
+
+        # the agent acts once every this many environment steps (see TinyWorld._agents_due)
+        self.stagger_period = 1
+
+        # the last result of pretty_current_interactions(), reused while the memory does not change
+        self._pretty_interactions_cache = None
+
         if not hasattr(self, 'episodic_memory'):
             # This default value MUST NOT be in the method signature, otherwise it will be shared across all instances.
             self.episodic_memory = EpisodicMemory()
@@ -239,8 +263,8 @@ class TinyPerson(JsonSerializableRegistry):
 
 
     def generate_agent_prompt(self):
-        with open(self._prompt_template_path, "r") as f:
-            agent_prompt_template = f.read()
+        # the template is read only once, since prompts are regenerated whenever the agent's state changes
+        agent_prompt_template = utils.read_prompt_template(self._prompt_template_path)
 
         # let's operate on top of a copy of the configuration, because we'll need to add more variables, etc.
         template_variables = self._configuration.copy()    
@@ -420,6 +444,9 @@ class TinyPerson(JsonSerializableRegistry):
 
         contents = []
 
+        # whatever was perceived so far is going to be reacted to now
+        self._has_new_stimuli = False
+
         # Aux function to perform exactly one action.
         # Occasionally, the model will return JSON missing important keys, so we just ask it to try again
         @repeat_on_error(retries=5, exceptions=[KeyError])
@@ -485,6 +512,57 @@ class TinyPerson(JsonSerializableRegistry):
         if return_actions:
             return contents
 
+    @transactional
+    def reactive_act(
+        self,
+        return_actions=False,
+        max_content_length=default["max_content_display_length"],
+    ):
+        """
+        Acts like act(), but only if the agent perceived new stimuli of one of the TinyPerson.REACTIVE_STIMULI_TYPES since 
+        it last acted. Otherwise, does nothing, so that no LLM call is made. This is how environments make reactive agents act.
+
+        Args:
+            return_actions (bool): Whether to return the actions or not. Defaults to False.
+        """
+        if self._has_new_stimuli:
+            return self.act(return_actions=return_actions, max_content_length=max_content_length)
+
+        if return_actions:
+            return []
+
+    def background_tick(self):
+        """
+        Advances the agent by one environment step without any reasoning, which is how environments make background 
+        agents act. This default implementation does nothing. Subclasses might override this method to implement 
+        cheap state updates (e.g., scripted routines).
+        """
+        pass
+
+    @transactional
+    def promote(self):
+        """
+        Moves the agent up one simulation tier (e.g., from background to reactive), unless it is already active.
+        """
+        index = TinyPerson.TIERS.index(self.tier)
+        if index < len(TinyPerson.TIERS) - 1:
+            self.tier = TinyPerson.TIERS[index + 1]
+            logger.debug(f"[{self.name}] Promoted to tier {self.tier}.")
+
+        return self
+
+    @transactional
+    def demote(self):
+        """
+        Moves the agent down one simulation tier (e.g., from active to reactive), unless it is already in the background.
+        """
+        index = TinyPerson.TIERS.index(self.tier)
+        if index > 0:
+            self.tier = TinyPerson.TIERS[index - 1]
+            logger.debug(f"[{self.name}] Demoted to tier {self.tier}.")
+
+        return self
+
     @transactional
     def listen(
         self,
@@ -509,6 +587,32 @@ class TinyPerson(JsonSerializableRegistry):
             max_content_length=max_content_length,
         )
 
+    @transactional
+    def listen_batch(
+        self,
+        messages: list,
+        max_content_length=default["max_content_display_length"],
+    ):
+        """
+        Listens to several speeches at once (e.g., messages that an environment delivers together) and updates 
+        its internal cognitive state only once for all of them.
+
+        Args:
+            messages (list): A list of (speech, source) pairs, where source is an AgentOrWorld or None.
+        """
+
+        return self._observe_stimuli(
+            stimuli=[
+                {
+                    "type": "CONVERSATION",
+                    "content": speech,
+                    "source": name_or_empty(source),
+                }
+                for speech, source in messages
+            ],
+            max_content_length=max_content_length,
+        )
+
     def socialize(
         self,
         social_description: str,
@@ -584,8 +688,9 @@ class TinyPerson(JsonSerializableRegistry):
 
     @transactional
     def _observe(self, stimulus, max_content_length=default["max_content_display_length"]):
-        stimuli = [stimulus]
+        return self._observe_stimuli([stimulus], max_content_length=max_content_length)
 
+    def _observe_stimuli(self, stimuli: list, max_content_length=default["max_content_display_length"]):
         content = {"stimuli": stimuli}
 
         logger.debug(f"[{self.name}] Observing stimuli: {content}")
@@ -595,6 +700,9 @@ class TinyPerson(JsonSerializableRegistry):
 
         self.episodic_memory.store({'role': 'user', 'content': content, 'simulation_timestamp': self.iso_datetime()})
 
+        if not self._has_new_stimuli:
+            self._has_new_stimuli = any(stimulus["type"] in TinyPerson.REACTIVE_STIMULI_TYPES for stimulus in stimuli)
+
         if TinyPerson.communication_display:
             self._display_communication(
                 role="user",
@@ -708,6 +816,29 @@ class TinyPerson(JsonSerializableRegistry):
                 f"[{self.name}] Agent {agent.name} is already accessible to {self.name}."
             )
 
+    @transactional
+    def make_agents_accessible(
+        self,
+        agents: list,
+        relation_description: str = "An agent I can currently interact with.",
+    ):
+        """
+        Makes several agents accessible to this agent at once. This has the same effect as calling 
+        `make_agent_accessible` for each of them, but is much cheaper when there are many agents.
+        """
+        already_accessible = set(self._accessible_agents)
+        for agent in agents:
+            if agent not in already_accessible:
+                already_accessible.add(agent)
+                self._accessible_agents.append(agent)
+                self._configuration["currently_accessible_agents"].append(
+                    {"name": agent.name, "relation_description": relation_description}
+                )
+            else:
+                logger.warning(
+                    f"[{self.name}] Agent {agent.name} is already accessible to {self.name}."
+                )
+
     @transactional
     def make_agent_inaccessible(self, agent: Self):
         """
@@ -918,6 +1049,14 @@ class TinyPerson(JsonSerializableRegistry):
       """
       Returns a pretty, readable, string with the current messages.
       """
+      # the result only changes when something is stored in memory, so the last one is reused until then
+      cache_key = None
+      if isinstance(self.episodic_memory, EpisodicMemory):
+          cache_key = (self.episodic_memory, self.episodic_memory.version, simplified, skip_system, max_content_length, first_n, last_n, include_omission_info)
+          cached = getattr(self, "_pretty_interactions_cache", None)
+          if cached is not None and cached[0] == cache_key:
+              return cached[1]
+
       lines = []
       for message in self.episodic_memory.retrieve(first_n=first_n, last_n=last_n, include_omission_info=include_omission_info):
         try:
@@ -962,7 +1101,11 @@ class TinyPerson(JsonSerializableRegistry):
             # print(f"ERROR: {message}")
             continue
 
-      return "\n".join(lines)
+      result = "\n".join(lines)
+      if cache_key is not None:
+          self._pretty_interactions_cache = (cache_key, result)
+
+      return result
 
     def _pretty_stimuli(
         self,
@@ -1138,6 +1281,7 @@ class TinyPerson(JsonSerializableRegistry):
         # delete the logger and other attributes that cannot be serialized
         del to_copy["environment"]
         del to_copy["_mental_faculties"]
+        to_copy.pop("_pretty_interactions_cache", None)
 
         to_copy["_accessible_agents"] = [agent.name for agent in self._accessible_agents]
         to_copy['episodic_memory'] = self.episodic_memory.to_json()
@@ -1548,6 +1692,10 @@ class EpisodicMemory(TinyMemory):
 
     MEMORY_BLOCK_OMISSION_INFO = {'role': 'assistant', 'content': "Info: there were other messages here, but they were omitted for brevity.", 'simulation_timestamp': None}
 
+    # incremented whenever the memory changes, so that views computed from it can be cached
+    version = 0
+    suppress_attributes_from_serialization = ["version"]
+
     def __init__(
         self, fixed_prefix_length: int = 100, lookback_length: int = 100
     ) -> None:
@@ -1568,6 +1716,7 @@ class EpisodicMemory(TinyMemory):
         Stores a value in memory.
         """
         self.memory.append(value)
+        self.version += 1
 
     def count(self) -> int:
         """
@@ -1734,6 +1883,8 @@ class SemanticMemory(TinyMemory):
 
         if documents_path not in self.documents_paths:
             self.documents_paths.append(documents_path)
+
+            from llama_index.core import SimpleDirectoryReader
             new_documents = SimpleDirectoryReader(documents_path).load_data()
             self._add_documents(new_documents, lambda doc: doc.metadata["file_name"])
     
@@ -1745,6 +1896,7 @@ class SemanticMemory(TinyMemory):
         self.documents_web_urls += filtered_web_urls
 
         if len(filtered_web_urls) > 0:
+            from llama_index.readers.web import SimpleWebPageReader
             new_documents = SimpleWebPageReader(html_to_text=True).load_data(filtered_web_urls)
             self._add_documents(new_documents, lambda doc: doc.id_)
     
@@ -1776,6 +1928,8 @@ class SemanticMemory(TinyMemory):
 
             # index documents for semantic retrieval
             if self.index is None:
+                _setup_llama_index()
+                from llama_index.core import VectorStoreIndex
                 self.index = VectorStoreIndex.from_documents(self.documents)
             else:
                 self.index.refresh(self.documents)
@@ -4,6 +4,7 @@ Simulation controlling mechanisms.
 import json
 import os
 import tempfile
+import rich
 
 import tinytroupe
 import tinytroupe.utils as utils
@@ -11,6 +12,47 @@ import tinytroupe.utils as utils
 import logging
 logger = logging.getLogger("tinytroupe")
 
+# The classes of simulated entities are resolved lazily (and only once) to avoid circular dependencies,
+# since the modules that define them themselves import this one.
+_TinyPerson = None
+_TinyWorld = None
+_TinyFactory = None
+
+def _types():
+    """
+    Returns the (TinyPerson, TinyWorld, TinyFactory) classes, importing them on first use.
+    """
+    global _TinyPerson, _TinyWorld, _TinyFactory
+    if _TinyPerson is None:
+        from tinytroupe.agent import TinyPerson
+        from tinytroupe.environment import TinyWorld
+        from tinytroupe.factory import TinyFactory
+        _TinyPerson, _TinyWorld, _TinyFactory = TinyPerson, TinyWorld, TinyFactory
+
+    return _TinyPerson, _TinyWorld, _TinyFactory
+
+def _event_key(obj):
+    """
+    Canonicalizes the given function call argument for the purpose of event hashing.
+    """
+    TinyPerson, TinyWorld, TinyFactory = _types()
+
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    elif isinstance(obj, TinyPerson):
+        return ["TinyPersonRef", obj.name]
+    elif isinstance(obj, TinyWorld):
+        return ["TinyWorldRef", obj.name]
+    elif isinstance(obj, TinyFactory):
+        return ["TinyFactoryRef", obj.name]
+    elif isinstance(obj, (list, tuple)):
+        return [_event_key(item) for item in obj]
+    elif isinstance(obj, dict):
+        return [[_event_key(key), _event_key(value)] for key, value in obj.items()]
+    else:
+        # other objects (e.g., timedelta) must still hash the same across runs, so we can't use their identities
+        return str(obj)
+
 class Simulation:
 
     STATUS_STOPPED = "stopped"
@@ -35,6 +77,9 @@ class Simulation:
         # should we always automatically checkpoint at the every transaction?
         self.auto_checkpoint = False
 
+        # should the decoding of cached states be deferred while replaying consecutive cache hits?
+        self.defer_cache_decoding = False
+
         # whether there are changes not yet saved to the cache file
         self.has_unsaved_cache_changes = False
 
@@ -60,7 +105,11 @@ class Simulation:
         # event_output is the output of the event, if any, and state is the actual complete state that resulted.
         self.execution_trace = []
 
-    def begin(self, cache_path:str=None, auto_checkpoint:bool=False):
+        # The state of the latest cache hit, if it was not decoded yet. Consecutive cache hits only need the
+        # last of their states decoded, so decoding is deferred until fresh execution (or the end) requires it.
+        self._pending_decode_state = None
+
+    def begin(self, cache_path:str=None, auto_checkpoint:bool=False, defer_cache_decoding:bool=False):
         """
         Marks the start of the simulation being controlled.
 
@@ -68,11 +117,12 @@ class Simulation:
             cache_path (str): The path to the cache file. If not specified, 
                     defaults to the default cache path defined in the class.
             auto_checkpoint (bool, optional): Whether to automatically checkpoint at the end of each transaction. Defaults to False.
+            defer_cache_decoding (bool, optional): Whether to decode only the last of consecutive cached states, right before
+                    the next fresh execution or the end of the simulation. This speeds up long replays, but agents and environments 
+                    are not up-to-date in-between, so it is only safe if their state is not inspected directly 
+                    (i.e., outside of their transactional methods) before that. Defaults to False.
         """
-        # local import to avoid circular dependencies
-        from tinytroupe.agent import TinyPerson
-        from tinytroupe.environment import TinyWorld
-        from tinytroupe.factory import TinyFactory
+        TinyPerson, TinyWorld, TinyFactory = _types()
 
         if self.status == Simulation.STATUS_STOPPED:
             self.status = Simulation.STATUS_STARTED
@@ -85,13 +135,16 @@ class Simulation:
         # should we automatically checkpoint?
         self.auto_checkpoint = auto_checkpoint
 
+        # should we defer the decoding of cached states?
+        self.defer_cache_decoding = defer_cache_decoding
+
         # clear the agents, environments and other simulated entities, we'll track them from now on
         TinyPerson.clear_agents()
         TinyWorld.clear_environments()
         TinyFactory.clear_factories()
 
         # All automated fresh ids will start from 0 again for this simulation
-        utils._fresh_id_counter = 0
+        utils.reset_fresh_id()
 
         # load the cache file, if any
         if self.cache_path is not None:
@@ -102,6 +155,7 @@ class Simulation:
         Marks the end of the simulation being controlled.
         """
         if self.status == Simulation.STATUS_STARTED:
+            self._flush_pending_decode()
             self.status = Simulation.STATUS_STOPPED
             self.checkpoint()
         else:
@@ -157,12 +211,15 @@ class Simulation:
         """
         return len(self.execution_trace) - 1
     
-    def _function_call_hash(self, function_name, *args, **kwargs) -> int:
+    def _function_call_hash(self, function_name, *args, **kwargs) -> list:
         """
-        Computes the hash of the given function call.
+        Computes the hash of the given function call. Simulated entities are represented by their names and
+        containers are traversed, so that no potentially large string representation needs to be built. The
+        result only uses JSON-native types, so that it compares equal to its counterpart loaded from the cache file.
         """
-        event = str((function_name, args, kwargs))
-        return event
+        key_args = [_event_key(arg) for arg in args]
+        key_kwargs = [[key, _event_key(value)] for key, value in sorted(kwargs.items())]
+        return [function_name, key_args, key_kwargs]
 
     def _skip_execution_with_cache(self):
         """
@@ -241,7 +298,8 @@ class Simulation:
         Loads the cache file from the given path.
         """
         try:
-            self.cached_trace = json.load(open(cache_path, "r"))
+            with open(cache_path, "r") as f:
+                self.cached_trace = json.load(f)
         except FileNotFoundError:
             logger.info(f"Cache file not found on path: {cache_path}.")
             self.cached_trace = []
@@ -324,17 +382,51 @@ class Simulation:
                 
         return state
         
-    def _decode_simulation_state(self, state: dict):
+    def _defer_decode_simulation_state(self, state: dict):
+        """
+        Schedules the given (cached) simulation state to be decoded later, displaying its communications right away
+        so that they still show up in the order they were produced.
+
+        Args:
+            state (dict): The state to decode.
+        """
+        TinyPerson, TinyWorld, _ = _types()
+
+        if TinyWorld.communication_display:
+            for environment_state in state["environments"]:
+                environment = self.name_to_environment[environment_state["name"]]
+                for communication in environment_state["_displayed_communications_buffer"]:
+                    environment._display(communication)
+
+        if TinyPerson.communication_display:
+            for agent_state in state["agents"]:
+                agent = self.name_to_agent[agent_state["name"]]
+                if agent.environment is None:
+                    for communication in agent_state["_displayed_communications_buffer"]:
+                        rich.print(communication)
+
+        self._pending_decode_state = state
+
+    def _flush_pending_decode(self):
+        """
+        Decodes the pending simulation state, if any. Its communications were already displayed when it was deferred.
+        """
+        if self._pending_decode_state is not None:
+            state = self._pending_decode_state
+            self._pending_decode_state = None
+            self._decode_simulation_state(state, display_communications=False)
+
+    def _decode_simulation_state(self, state: dict, display_communications:bool=True):
         """
         Decodes the given simulation state, including agents, environments, and other
         relevant information.
 
         Args:
             state (dict): The state to decode.
+            display_communications (bool, optional): Whether to display the communications buffered in the state. If False, 
+                they are just cleared. Defaults to True.
         """
-        # local import to avoid circular dependencies
-        from tinytroupe.agent import TinyPerson
-        from tinytroupe.environment import TinyWorld
+        TinyPerson, TinyWorld, _ = _types()
 
         logger.debug(f"Decoding simulation state: {state['factories']}")
         logger.debug(f"Registered factories: {self.name_to_factory}")
@@ -346,20 +438,22 @@ class Simulation:
             factory = self.name_to_factory[factory_state["name"]]
             factory.decode_complete_state(factory_state)
 
-        # Decode environments
-        ###self.environments = []
+        # Decode environments and agents in-place. They are looked up through the name maps populated by add_environment
+        # and add_agent, so self.environments and self.agents are already complete and must not be appended to here.
         for environment_state in state["environments"]:
             try:
                 environment = self.name_to_environment[environment_state["name"]]
                 environment.decode_complete_state(environment_state)
                 if TinyWorld.communication_display:
-                    environment.pop_and_display_latest_communications()
+                    if display_communications:
+                        environment.pop_and_display_latest_communications()
+                    else:
+                        environment.clear_communications_buffer()
 
             except Exception as e:
                 raise ValueError(f"Environment {environment_state['name']} is not in the simulation, thus cannot be decoded there.") from e
 
         # Decode agents (if they were not already decoded by the environment)
-        ####self.agents = []
         for agent_state in state["agents"]:
             try:
                 agent = self.name_to_agent[agent_state["name"]]
@@ -368,7 +462,10 @@ class Simulation:
                 # The agent has not yet been decoded because it is not in any environment. So, decode it.
                 if agent.environment is None:
                     if TinyPerson.communication_display:
-                        agent.pop_and_display_latest_communications()
+                        if display_communications:
+                            agent.pop_and_display_latest_communications()
+                        else:
+                            agent.clear_communications_buffer()
             except Exception as e:
                 raise ValueError(f"Agent {agent_state['name']} is not in the simulation, thus cannot be decoded there.") from e        
 
@@ -376,10 +473,7 @@ class Simulation:
 class Transaction:
 
     def __init__(self, obj_under_transaction, simulation, function, *args, **kwargs):
-        # local import to avoid circular dependencies
-        from tinytroupe.agent import TinyPerson
-        from tinytroupe.environment import TinyWorld
-        from tinytroupe.factory import TinyFactory
+        TinyPerson, TinyWorld, TinyFactory = _types()
 
         self.obj_under_transaction = obj_under_transaction
         self.simulation = simulation
@@ -397,7 +491,8 @@ class Transaction:
                     raise ValueError(f"Object {obj_under_transaction} is already captured by a different simulation (id={obj_under_transaction.simulation_id}), \
                                     and cannot be captured by simulation id={simulation.id}.")
                 
-                logger.debug(f">>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Object {obj_under_transaction} is already captured by simulation {simulation.id}.")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f">>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Object {obj_under_transaction} is already captured by simulation {simulation.id}.")
             else:
                 # if is a TinyPerson, add the agent to the simulation
                 if isinstance(obj_under_transaction, TinyPerson):
@@ -420,60 +515,71 @@ class Transaction:
     def execute(self):
 
         output = None
+        simulation = self.simulation
 
         # Transaction caching will only operate if there is a simulation and it is started
-        if self.simulation is None or self.simulation.status == Simulation.STATUS_STOPPED:
+        if simulation is None or simulation.status == Simulation.STATUS_STOPPED:
             # Compute the function and return it, no caching, since the simulation is not started
             output = self.function(*self.args, **self.kwargs)
         
-        elif self.simulation.status == Simulation.STATUS_STARTED:
-            # Compute the event hash
-            event_hash = self.simulation._function_call_hash(self.function_name, *self.args, **self.kwargs)
-
-            # Check if the event hash is in the cache
-            if self.simulation._is_transaction_event_cached(event_hash):
-                # Restore the full state and return the cached output
-                logger.info(f"Skipping execution of {self.function_name} with args {self.args} and kwargs {self.kwargs} because it is already cached.")
-
-                self.simulation._skip_execution_with_cache()
-                state = self.simulation.cached_trace[self.simulation._execution_trace_position()][3] # state
-                self.simulation._decode_simulation_state(state)
-                
-                # Output encoding/decoding is used to preserve references to TinyPerson and TinyWorld instances
-                # mainly. Scalar values (int, float, str, bool) and composite values (list, dict) are 
-                # encoded/decoded as is.
-                encoded_output = self.simulation.cached_trace[self.simulation._execution_trace_position()][2] # output
-                output = self._decode_function_output(encoded_output)
+        elif simulation.status == Simulation.STATUS_STARTED:
 
-            else: # not cached
-                
-                # reentrant transactions are not cached, since what matters is the final result of
-                # the top-level transaction
-                if not self.simulation.is_under_transaction():
-                    self.simulation.begin_transaction()
+            # reentrant transactions are just run, but not cached, since what matters is the final result of
+            # the top-level transaction. The cached trace suffix was already dropped when the top-level transaction
+            # started, so there's no point in computing their event hashes and looking them up in the cache either.
+            if simulation.is_under_transaction():
+                output = self.function(*self.args, **self.kwargs)
+            
+            else:
+                # Compute the event hash
+                event_hash = simulation._function_call_hash(self.function_name, *self.args, **self.kwargs)
+
+                # Check if the event hash is in the cache
+                if simulation._is_transaction_event_cached(event_hash):
+                    # Restore the full state and return the cached output
+                    if logger.isEnabledFor(logging.INFO):
+                        logger.info(f"Skipping execution of {self.function_name} with args {self.args} and kwargs {self.kwargs} because it is already cached.")
+
+                    simulation._skip_execution_with_cache()
+                    _, _, encoded_output, state = simulation.execution_trace[-1] # the cached node just skipped to
+
+                    if simulation.defer_cache_decoding:
+                        # a subsequent cache hit would overwrite the state anyway
+                        simulation._defer_decode_simulation_state(state)
+                    else:
+                        simulation._decode_simulation_state(state)
+                    
+                    # Output encoding/decoding is used to preserve references to TinyPerson and TinyWorld instances
+                    # mainly. Scalar values (int, float, str, bool) and composite values (list, dict) are 
+                    # encoded/decoded as is.
+                    output = self._decode_function_output(encoded_output)
+
+                else: # not cached
+                    # fresh execution must start from the latest cached state
+                    simulation._flush_pending_decode()
+
+                    simulation.begin_transaction()
 
                     # immediately drop the cached trace suffix, since we are starting a new execution from this point on
-                    self.simulation._drop_cached_trace_suffix()
+                    simulation._drop_cached_trace_suffix()
                     
                     # Compute the function, cache the result and return it
                     output = self.function(*self.args, **self.kwargs)
 
                     encoded_output = self._encode_function_output(output)
-                    state = self.simulation._encode_simulation_state()
+                    state = simulation._encode_simulation_state()
                                   
-                    self.simulation._add_to_cache_trace(state, event_hash, encoded_output)
-                    self.simulation._add_to_execution_trace(state, event_hash, encoded_output)
+                    simulation._add_to_cache_trace(state, event_hash, encoded_output)
+                    simulation._add_to_execution_trace(state, event_hash, encoded_output)
+
+                    simulation.end_transaction()
 
-                    self.simulation.end_transaction()
-                
-                else: # reentrant transactions are just run, but not cached
-                    output = self.function(*self.args, **self.kwargs)
         else:
-            raise ValueError(f"Simulation status is invalid at this point: {self.simulation.status}")
+            raise ValueError(f"Simulation status is invalid at this point: {simulation.status}")
 
         # Checkpoint if needed
-        if self.simulation is not None and self.simulation.auto_checkpoint:
-            self.simulation.checkpoint()
+        if simulation is not None and simulation.auto_checkpoint:
+            simulation.checkpoint()
 
         return output
   
@@ -481,10 +587,7 @@ class Transaction:
         """
         Encodes the given function output.
         """
-        # local import to avoid circular dependencies
-        from tinytroupe.agent import TinyPerson
-        from tinytroupe.environment import TinyWorld
-        from tinytroupe.factory import TinyFactory
+        TinyPerson, TinyWorld, TinyFactory = _types()
 
 
         # if the output is a TinyPerson, encode it
@@ -509,10 +612,7 @@ class Transaction:
         """
         Decodes the given encoded function output.
         """
-        # local import to avoid circular dependencies
-        from tinytroupe.agent import TinyPerson
-        from tinytroupe.environment import TinyWorld
-        from tinytroupe.factory import TinyFactory
+        TinyPerson, TinyWorld, TinyFactory = _types()
 
         if encoded_output is None:
             return None
@@ -536,7 +636,8 @@ def transactional(func):
         simulation = current_simulation()
         obj_sim_id = obj_under_transaction.simulation_id if hasattr(obj_under_transaction, 'simulation_id') else None
 
-        logger.debug(f"-----------------------------------------> Transaction: {func.__name__} with args {args[1:]} and kwargs {kwargs} under simulation {obj_sim_id}.")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"-----------------------------------------> Transaction: {func.__name__} with args {args[1:]} and kwargs {kwargs} under simulation {obj_sim_id}.")
         
         transaction = Transaction(obj_under_transaction, simulation, func, *args, **kwargs)
         result = transaction.execute()
@@ -583,13 +684,13 @@ def _simulation(id="default"):
     
     return _current_simulations[id]
 
-def begin(cache_path=None, id="default", auto_checkpoint=False):
+def begin(cache_path=None, id="default", auto_checkpoint=False, defer_cache_decoding=False):
     """
     Marks the start of the simulation being controlled.
     """
     global _current_simulation_id
     if _current_simulation_id is None:
-        _simulation(id).begin(cache_path, auto_checkpoint)
+        _simulation(id).begin(cache_path, auto_checkpoint, defer_cache_decoding)
         _current_simulation_id = id
     else:
         raise ValueError(f"Simulation is already started under id {_current_simulation_id}. Currently only one simulation can be started at a time.")   
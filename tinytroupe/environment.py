@@ -6,7 +6,10 @@ agents interact with each other as well as external entities (e.g., search engin
 import logging
 logger = logging.getLogger("tinytroupe")
 import copy
+import pickle
+import heapq
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 from tinytroupe.agent import *
 from tinytroupe.utils import name_or_empty, pretty_datetime
@@ -29,9 +32,20 @@ class TinyWorld:
     # Whether to display environments communications or not, for all environments. 
     communication_display = True
 
+    # The console shared by all environments to display their communications, unless one is set with set_console().
+    _default_console = Console()
+
+    # The maximum number of agents that can act at the same time, when agents act in parallel.
+    MAX_PARALLEL_AGENT_ACTIONS = 32
+
+    # Attributes that are not part of the encoded state, because they are either encoded separately or runtime resources.
+    state_excluded_attributes = ["console", "_executor", "agents", "_agent_set", "name_to_agent", "_listeners", "_schedule", "_pending_messages", "_action_handlers", "current_datetime"]
+
     def __init__(self, name: str="A TinyWorld", agents=[], 
                  initial_datetime=datetime.datetime.now(),
-                 broadcast_if_no_target=True):
+                 broadcast_if_no_target=True,
+                 parallel_agent_actions=False,
+                 batch_messages=False):
         """
         Initializes an environment.
 
@@ -41,22 +55,47 @@ class TinyWorld:
             initial_datetime (datetime): The initial datetime of the environment, or None (i.e., explicit time is optional). 
                 Defaults to the current datetime in the real world.
             broadcast_if_no_target (bool): If True, broadcast actions if the target of an action is not found.
+            parallel_agent_actions (bool): If True, agents act concurrently within each step, so that their LLM calls are 
+                issued together instead of one agent at a time. Their actions are still handled sequentially afterwards, 
+                in the order of the agents, but this means that agents only perceive each other's actions in the next step.
+            batch_messages (bool): If True, the messages agents send each other during a step are delivered together at the end 
+                of the step, so that each recipient listens to all of them at once. Like parallel_agent_actions, this means 
+                that agents only perceive such messages in the next step.
         """
 
         self.name = name
         self.current_datetime = initial_datetime
         self.broadcast_if_no_target = broadcast_if_no_target
+        self.parallel_agent_actions = parallel_agent_actions
+
+        # below this number of agents, parallel acting is not worth the threading overhead
+        self.sequential_threshold = 2
+
+        # the thread pool used when agents act in parallel, created on demand and reused across steps
+        self._executor = None
+
+        self._tick = 0 # the number of steps performed so far, used to stagger agents that do not act at every step
+        self._schedule = None # heap of (due_tick, position, agent), built on demand from the agents and the current tick
+
+        self.batch_messages = batch_messages
+        self._pending_messages = None # {agent: [(speech, source), ...]} while a step is batching messages
         self.simulation_id = None # will be reset later if the agent is used within a specific simulation scope
         
         
         self.agents = []
+        self._agent_set = set() # the same agents as self.agents, for fast membership tests
         self.name_to_agent = {} # {agent_name: agent, agent_name_2: agent_2, ...}
+        self._listeners = [] # [(agent, agent.listen), ...], kept in sync with self.agents for fast broadcasts
+
+        # only some actions require the environment to intervene. Subclasses can register handlers for further action types here.
+        self._action_handlers = {"REACH_OUT": self._handle_reach_out, 
+                                 "TALK": self._handle_talk} # {action_type: handler(source, content, target), ...}
 
         # the buffer of communications that have been displayed so far, used for
         # saving these communications to another output form later (e.g., caching)
         self._displayed_communications_buffer = []
 
-        self.console = Console()
+        self.console = TinyWorld._default_console
 
         # add the environment to the list of all environments
         TinyWorld.add_environment(self)
@@ -79,17 +118,112 @@ class TinyWorld:
         # in the correct time, particularly if only one step is being run.
         self._advance_datetime(timedelta_per_step)
 
-        # agents can act
+        if self.batch_messages:
+            self._pending_messages = {}
+
+        try:
+            agents_actions = self._act_and_handle_actions()
+
+            # deliver the messages batched during the step, if any
+            if self._pending_messages is not None:
+                pending_messages = self._pending_messages
+                self._pending_messages = None
+
+                for agent, messages in pending_messages.items():
+                    agent.listen_batch(messages)
+
+        finally:
+            self._pending_messages = None
+
+        self._tick += 1
+
+        return agents_actions
+
+    def _act_and_handle_actions(self):
+        """
+        Makes the agents that are due in the current step act according to their simulation tiers and handles the resulting actions. 
+        Active agents act through the LLM, reactive agents only if they have something to react to, and background 
+        agents just tick.
+        """
         agents_actions = {}
-        for agent in self.agents:
-            logger.debug(f"[{self.name}] Agent {name_or_empty(agent)} is acting.")
-            actions = agent.act(return_actions=True)
-            agents_actions[agent.name] = actions
 
-            self._handle_actions(agent, agent.pop_latest_actions())
+        acting_agents = [] # [(agent, act_method), ...]
+        for agent in self._agents_due():
+            if agent.tier == TinyPerson.TIER_ACTIVE:
+                acting_agents.append((agent, agent.act))
+            elif agent.tier == TinyPerson.TIER_REACTIVE:
+                acting_agents.append((agent, agent.reactive_act))
+            else:
+                agent.background_tick()
+                agents_actions[agent.name] = []
+
+        if self.parallel_agent_actions and len(acting_agents) >= self.sequential_threshold:
+            # all agents act at once, which is dominated by waiting for the LLM, and only then are their actions handled.
+            # Handling follows the agents order rather than completion order, to keep simulations reproducible.
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=TinyWorld.MAX_PARALLEL_AGENT_ACTIONS)
+
+            futures = [(agent, self._executor.submit(act, return_actions=True)) for agent, act in acting_agents]
+
+            for agent, future in futures:
+                agents_actions[agent.name] = future.result()
+                self._handle_actions(agent, agent.pop_latest_actions())
+
+        else:
+            for agent, act in acting_agents:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"[{self.name}] Agent {name_or_empty(agent)} is acting.")
+                actions = act(return_actions=True)
+                agents_actions[agent.name] = actions
+
+                self._handle_actions(agent, agent.pop_latest_actions())
         
         return agents_actions
 
+    def _agents_due(self):
+        """
+        Returns the agents that are due in the current step, in the agents order. Agents with a stagger_period of N are 
+        only due once every N steps, and agents sharing the same period take turns, so that their (expensive) acting 
+        is spread evenly across steps instead of happening all at once.
+
+        Agents wait in a schedule ordered by the step at which they are next due, so only the agents that are due 
+        are touched. Once popped, an agent is rescheduled according to its current stagger_period.
+        """
+        if self._schedule is None:
+            self._schedule = self._build_schedule()
+
+        schedule = self._schedule
+        due = []
+        while schedule and schedule[0][0] <= self._tick:
+            due.append(heapq.heappop(schedule))
+
+        # agents are popped by due step, but must act in the agents order
+        due.sort(key=lambda entry: entry[1])
+
+        due_agents = []
+        for _, position, agent in due:
+            heapq.heappush(schedule, (self._tick + max(agent.stagger_period, 1), position, agent))
+            due_agents.append(agent)
+
+        return due_agents
+
+    def _build_schedule(self):
+        """
+        Builds the schedule used by _agents_due from the current agents and step. 
+        """
+        schedule = []
+        turns = {} # {stagger_period: number of agents with that period seen so far}
+        for position, agent in enumerate(self.agents):
+            period = max(agent.stagger_period, 1)
+            turn = turns.get(period, 0)
+            turns[period] = turn + 1
+
+            # the first step, from now on, in which it is this agent's turn
+            schedule.append((self._tick + (turn - self._tick) % period, position, agent))
+
+        heapq.heapify(schedule)
+        return schedule
+
     def _advance_datetime(self, timedelta):
         """
         Advances the current datetime of the environment by the specified timedelta.
@@ -276,7 +410,7 @@ class TinyWorld:
         """
 
         # check if the agent is not already in the environment
-        if agent not in self.agents:
+        if agent not in self._agent_set:
             logger.debug(f"Adding agent {agent.name} to the environment.")
             
             # Agent names must be unique in the environment. 
@@ -284,7 +418,10 @@ class TinyWorld:
             if agent.name not in self.name_to_agent:
                 agent.environment = self
                 self.agents.append(agent)
+                self._agent_set.add(agent)
                 self.name_to_agent[agent.name] = agent
+                self._listeners.append((agent, agent.listen))
+                self._schedule = None
             else:
                 raise ValueError(f"Agent names must be unique, but '{agent.name}' is already in the environment.")
         else:
@@ -301,7 +438,10 @@ class TinyWorld:
         """
         logger.debug(f"Removing agent {agent.name} from the environment.")
         self.agents.remove(agent)
+        self._agent_set.discard(agent)
         del self.name_to_agent[agent.name]
+        self._listeners = [(a, listen) for a, listen in self._listeners if a is not agent]
+        self._schedule = None
 
         return self # for chaining
     
@@ -311,7 +451,10 @@ class TinyWorld:
         """
         logger.debug(f"Removing all agents from the environment.")
         self.agents = []
+        self._agent_set = set()
         self.name_to_agent = {}
+        self._listeners = []
+        self._schedule = None
 
         return self # for chaining
 
@@ -349,18 +492,19 @@ class TinyWorld:
               JSON specification.
             
         """
+        action_handlers = self._action_handlers
         for action in actions:
             action_type = action["type"] # this is the only required field
-            content = action["content"] if "content" in action else None
-            target = action["target"] if "target" in action else None
+            content = action.get("content")
+            target = action.get("target")
 
-            logger.debug(f"[{self.name}] Handling action {action_type} from agent {name_or_empty(source)}. Content: {content}, target: {target}.")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"[{self.name}] Handling action {action_type} from agent {name_or_empty(source)}. Content: {content}, target: {target}.")
 
             # only some actions require the enviroment to intervene
-            if action_type == "REACH_OUT":
-                self._handle_reach_out(source, content, target)
-            elif action_type == "TALK":
-                self._handle_talk(source, content, target)
+            handler = action_handlers.get(action_type)
+            if handler is not None:
+                handler(source, content, target)
 
     @transactional
     def _handle_reach_out(self, source_agent: TinyPerson, content: str, target: str):
@@ -380,6 +524,8 @@ class TinyWorld:
         source_agent.make_agent_accessible(target_agent)
         target_agent.make_agent_accessible(source_agent)
 
+        self._engage(target_agent)
+
         source_agent.socialize(f"{name_or_empty(target_agent)} was successfully reached out, and is now available for interaction.", source=self)
         target_agent.socialize(f"{name_or_empty(source_agent)} reached out to you, and is now available for interaction.", source=self)
 
@@ -395,13 +541,31 @@ class TinyWorld:
         """
         target_agent = self.get_agent_by_name(target)
 
-        logger.debug(f"[{self.name}] Delivering message from {name_or_empty(source_agent)} to {name_or_empty(target_agent)}.")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"[{self.name}] Delivering message from {name_or_empty(source_agent)} to {name_or_empty(target_agent)}.")
 
         if target_agent is not None:
-            target_agent.listen(content, source=source_agent)
+            if self._pending_messages is not None:
+                self._pending_messages.setdefault(target_agent, []).append((content, source_agent))
+            else:
+                target_agent.listen(content, source=source_agent)
+
+            self._engage(target_agent)
         elif self.broadcast_if_no_target:
             self.broadcast(content, source=source_agent)
 
+    def _engage(self, agent: TinyPerson):
+        """
+        Called when another agent directly engages with the specified agent (e.g., by talking to it). This default 
+        implementation promotes background agents to the reactive tier, so that they can respond. Subclasses might 
+        override this method to implement different promotion policies.
+
+        Args:
+            agent (TinyPerson): The agent that was engaged with.
+        """
+        if agent.tier == TinyPerson.TIER_BACKGROUND:
+            agent.promote()
+
     #######################################################################
     # Interaction methods
     #######################################################################
@@ -414,12 +578,17 @@ class TinyWorld:
             speech (str): The content of the message.
             source (AgentOrWorld, optional): The agent or environment that issued the message. Defaults to None.
         """
-        logger.debug(f"[{self.name}] Broadcasting message: '{speech}'.")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"[{self.name}] Broadcasting message: '{speech}'.")
 
-        for agent in self.agents:
+        pending_messages = self._pending_messages
+        for agent, listen in self._listeners:
             # do not deliver the message to the source
-            if agent != source:
-                agent.listen(speech, source=source)
+            if agent is not source:
+                if pending_messages is not None:
+                    pending_messages.setdefault(agent, []).append((speech, source))
+                else:
+                    listen(speech, source=source)
     
     @transactional
     def broadcast_thought(self, thought: str, source: AgentOrWorld=None):
@@ -429,7 +598,8 @@ class TinyWorld:
         Args:
             thought (str): The content of the thought.
         """
-        logger.debug(f"[{self.name}] Broadcasting thought: '{thought}'.")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"[{self.name}] Broadcasting thought: '{thought}'.")
 
         for agent in self.agents:
             agent.think(thought)
@@ -442,7 +612,8 @@ class TinyWorld:
         Args:
             internal_goal (str): The content of the internal goal.
         """
-        logger.debug(f"[{self.name}] Broadcasting internal goal: '{internal_goal}'.")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"[{self.name}] Broadcasting internal goal: '{internal_goal}'.")
 
         for agent in self.agents:
             agent.internalize_goal(internal_goal)
@@ -455,7 +626,8 @@ class TinyWorld:
         Args:
             context (list): The content of the context change.
         """
-        logger.debug(f"[{self.name}] Broadcasting context change: '{context}'.")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"[{self.name}] Broadcasting context change: '{context}'.")
 
         for agent in self.agents:
             agent.change_context(context)
@@ -464,10 +636,8 @@ class TinyWorld:
         """
         Makes all agents in the environment accessible to each other.
         """
-        for agent_1 in self.agents:
-            for agent_2 in self.agents:
-                if agent_1 != agent_2:
-                    agent_1.make_agent_accessible(agent_2)
+        for agent in self.agents:
+            agent.make_agents_accessible([other for other in self.agents if other is not agent])
             
 
     ###########################################################
@@ -536,6 +706,17 @@ class TinyWorld:
 
         return rendering
 
+    def set_console(self, console: Console):
+        """
+        Sets the console used to display the communications of this environment, instead of the shared one.
+
+        Args:
+            console (Console): The rich console to use.
+        """
+        self.console = console
+
+        return self # for chaining
+
     def pp_current_interactions(self, simplified=True, skip_system=True):
         """
         Pretty prints the current messages from agents in this environment.
@@ -568,15 +749,8 @@ class TinyWorld:
         Returns:
             dict: A dictionary encoding the complete state of the environment.
         """
-        to_copy = copy.copy(self.__dict__)
-
-        # remove the logger and other fields
-        del to_copy['console']
-        del to_copy['agents']
-        del to_copy['name_to_agent']
-        del to_copy['current_datetime']
-
-        state = copy.deepcopy(to_copy)
+        state = TinyWorld._copy_state_values({key: value for key, value in self.__dict__.items() 
+                                              if key not in self.state_excluded_attributes})
 
         # agents are encoded separately
         state["agents"] = [agent.encode_complete_state() for agent in self.agents]
@@ -596,13 +770,15 @@ class TinyWorld:
         Returns:
             Self: The environment decoded from the dictionary.
         """
-        state = copy.deepcopy(state)
+        # agents copy their own states when decoding them, so only the rest of the state must be copied here
+        agents_states = state["agents"]
+        state = TinyWorld._copy_state_values({key: value for key, value in state.items() if key != "agents"})
 
         #################################
         # restore agents in-place
         #################################
         self.remove_all_agents()
-        for agent_state in state["agents"]:
+        for agent_state in agents_states:
             try:
                 try:
                     agent = TinyPerson.get_agent_by_name(agent_state["name"])
@@ -614,9 +790,6 @@ class TinyWorld:
                 
             except Exception as e:
                 raise ValueError(f"Could not decode agent {agent_state['name']} for environment {self.name}.") from e
-        
-        # remove the agent states to update the rest of the environment
-        del state["agents"]
 
         # restore datetime
         state["current_datetime"] = datetime.datetime.fromisoformat(state["current_datetime"])
@@ -626,6 +799,25 @@ class TinyWorld:
 
         return self
 
+    @staticmethod
+    def _copy_state_values(values: dict) -> dict:
+        """
+        Copies the specified state values, so that the state and the environment do not share mutable objects.
+        Immutable values are kept as they are.
+        """
+        copied = {}
+        to_copy = {}
+        for key, value in values.items():
+            if value is None or isinstance(value, (str, int, float, bool)):
+                copied[key] = value
+            else:
+                to_copy[key] = value
+
+        # a pickle round-trip is much faster than a deepcopy, and still isolates the copies from the original values
+        copied.update(pickle.loads(pickle.dumps(to_copy, protocol=pickle.HIGHEST_PROTOCOL)))
+
+        return copied
+
     @staticmethod
     def add_environment(environment):
         """
@@ -674,7 +866,10 @@ class TinyWorld:
 
 class TinySocialNetwork(TinyWorld):
 
-    def __init__(self, name, broadcast_if_no_target=True):
+    # relations refer to agents, so they are encoded separately, by agent names
+    state_excluded_attributes = TinyWorld.state_excluded_attributes + ["relations", "_pair_to_relations"]
+
+    def __init__(self, name, broadcast_if_no_target=True, parallel_agent_actions=False, batch_messages=False):
         """
         Create a new TinySocialNetwork environment.
 
@@ -682,11 +877,33 @@ class TinySocialNetwork(TinyWorld):
             name (str): The name of the environment.
             broadcast_if_no_target (bool): If True, broadcast actions through an agent's available relations
               if the target of an action is not found.
+            parallel_agent_actions (bool): If True, agents act concurrently within each step. See TinyWorld.
+            batch_messages (bool): If True, messages sent during a step are delivered together at the end of the step. See TinyWorld.
         """
         
-        super().__init__(name, broadcast_if_no_target=broadcast_if_no_target)
+        super().__init__(name, broadcast_if_no_target=broadcast_if_no_target, parallel_agent_actions=parallel_agent_actions, 
+                         batch_messages=batch_messages)
 
         self.relations = {}
+        self._pair_to_relations = {} # {frozenset({agent_1, agent_2}): {relation_name, ...}, ...}
+
+        # whether relations or agents changed since agents' accessibility was last updated from the relations
+        self._relations_dirty = True
+
+    def add_agent(self, agent: TinyPerson):
+        super().add_agent(agent)
+        self._relations_dirty = True
+        return self # for chaining
+
+    def remove_agent(self, agent: TinyPerson):
+        super().remove_agent(agent)
+        self._relations_dirty = True
+        return self # for chaining
+
+    def remove_all_agents(self):
+        super().remove_all_agents()
+        self._relations_dirty = True
+        return self # for chaining
     
     @transactional
     def add_relation(self, agent_1, agent_2, name="default"):
@@ -702,41 +919,58 @@ class TinySocialNetwork(TinyWorld):
         logger.debug(f"Adding relation {name} between {agent_1.name} and {agent_2.name}.")
 
         # agents must already be in the environment, if not they are first added
-        if agent_1 not in self.agents:
-            self.agents.append(agent_1)
-        if agent_2 not in self.agents:
-            self.agents.append(agent_2)
-
-        if name in self.relations:
-            self.relations[name].append((agent_1, agent_2))
+        if agent_1 not in self._agent_set:
+            self.add_agent(agent_1)
+        if agent_2 not in self._agent_set:
+            self.add_agent(agent_2)
+
+        # relations are undirected, so they are indexed by the unordered pair of agents
+        relation_names = self._pair_to_relations.setdefault(frozenset((agent_1, agent_2)), set())
+        if name in relation_names:
+            logger.warning(f"Agents {agent_1.name} and {agent_2.name} are already in relation {name}.")
         else:
-            self.relations[name] = [(agent_1, agent_2)]
+            relation_names.add(name)
+            self._relations_dirty = True
+
+            if name in self.relations:
+                self.relations[name].append((agent_1, agent_2))
+            else:
+                self.relations[name] = [(agent_1, agent_2)]
 
         return self # for chaining
     
     @transactional
     def _update_agents_contexts(self):
         """
-        Updates the agents' observations based on the current state of the world.
+        Updates the agents' observations based on the current state of the world. This is only done when
+        relations or agents changed since the last update, as otherwise the result would be the same.
         """
+        if not self._relations_dirty:
+            return
 
         # clear all accessibility first
         for agent in self.agents:
             agent.make_all_agents_inaccessible()
 
-        # now update accessibility based on relations
+        # now update accessibility based on relations, all at once for each agent
+        accessible_agents = {agent: [] for agent in self.agents}
         for relation_name, relation in self.relations.items():
             logger.debug(f"Updating agents' observations for relation {relation_name}.")
             for agent_1, agent_2 in relation:
-                agent_1.make_agent_accessible(agent_2)
-                agent_2.make_agent_accessible(agent_1)
+                accessible_agents.setdefault(agent_1, []).append(agent_2)
+                accessible_agents.setdefault(agent_2, []).append(agent_1)
+
+        for agent, others in accessible_agents.items():
+            agent.make_agents_accessible(others)
+
+        self._relations_dirty = False
 
     @transactional
-    def _step(self):
+    def _step(self, timedelta_per_step=None):
         self._update_agents_contexts()
 
         #call super
-        super()._step()
+        return super()._step(timedelta_per_step=timedelta_per_step)
     
     @transactional
     def _handle_reach_out(self, source_agent: TinyPerson, content: str, target: str):
@@ -750,12 +984,11 @@ class TinySocialNetwork(TinyWorld):
             target (str): The target of the message.
         """
             
-        # check if the target is in the same relation as the source
+        # check if the target is in the same relation as the source (a single lookup in the relations index)
         if self.is_in_relation_with(source_agent, self.get_agent_by_name(target)):
             super()._handle_reach_out(source_agent, content, target)
-            
-        # if we get here, the target is not in the same relation as the source
-        source_agent.socialize(f"{target} is not in the same relation as you, so you cannot reach out to them.", source=self)
+        else:
+            source_agent.socialize(f"{target} is not in the same relation as you, so you cannot reach out to them.", source=self)
 
 
     # TODO implement _handle_talk using broadcast_if_no_target too
@@ -778,14 +1011,41 @@ class TinySocialNetwork(TinyWorld):
         Returns:
             bool: True if the two agents are in the given relation, False otherwise.
         """
+        relation_names = self._pair_to_relations.get(frozenset((agent_1, agent_2)), ())
+
         if relation_name is None:
-            for relation_name, relation in self.relations.items():
-                if (agent_1, agent_2) in relation or (agent_2, agent_1) in relation:
-                    return True
-            return False
-        
+            return len(relation_names) > 0
         else:
-            if relation_name in self.relations:
-                return (agent_1, agent_2) in self.relations[relation_name] or (agent_2, agent_1) in self.relations[relation_name]
-            else:
-                return False
\ No newline at end of file
+            return relation_name in relation_names
+
+    #######################################################################
+    # IO
+    #######################################################################
+
+    def encode_complete_state(self) -> dict:
+        state = super().encode_complete_state()
+        state["relations"] = {relation_name: [[agent_1.name, agent_2.name] for agent_1, agent_2 in relation] 
+                              for relation_name, relation in self.relations.items()}
+
+        return state
+
+    def decode_complete_state(self, state: dict) -> Self:
+        state = copy.copy(state)
+        relations = state.pop("relations")
+
+        super().decode_complete_state(state)
+
+        # rebuild the relations, and their index, from the agent names. Related agents are always in the network,
+        # so they can be found locally.
+        name_to_agent = self.name_to_agent
+        self.relations = {}
+        self._pair_to_relations = {}
+        for relation_name, relation in relations.items():
+            self.relations[relation_name] = []
+            for agent_1_name, agent_2_name in relation:
+                agent_1 = name_to_agent[agent_1_name]
+                agent_2 = name_to_agent[agent_2_name]
+                self.relations[relation_name].append((agent_1, agent_2))
+                self._pair_to_relations.setdefault(frozenset((agent_1, agent_2)), set()).add(relation_name)
+
+        return self
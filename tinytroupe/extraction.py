@@ -11,6 +11,7 @@ one of the many ways in which agent simulations differ from AI assistants, as th
 
 import os
 import json
+import asyncio
 import chevron
 import logging
 import pandas as pd
@@ -34,6 +35,14 @@ class ResultsExtractor:
     def __init__(self):
         self._extraction_prompt_template_path = os.path.join(os.path.dirname(__file__), 'prompts/interaction_results_extractor.mustache')
 
+        # the template is read only once, since it is used in every extraction
+        self._extraction_prompt_template = utils.read_prompt_template(self._extraction_prompt_template_path)
+
+        # system messages are rendered only once per set of fields, and are kept byte-identical across calls, 
+        # so that providers with automatic prompt caching can reuse the common prompt prefix
+        self._system_message_no_fields = {"role": "system", "content": chevron.render(self._extraction_prompt_template, {})}
+        self._system_messages_with_fields = {}
+
         # we'll cache the last extraction results for each type of extraction, so that we can use them to
         # generate reports or other additional outputs.
         self.agent_extraction = {}
@@ -45,7 +54,8 @@ class ResultsExtractor:
                         situation:str = "", 
                         fields:list=None,
                         fields_hints:dict=None,
-                        verbose:bool=False):
+                        verbose:bool=False,
+                        max_history_tokens:int=4096):
         """
         Extracts results from a TinyPerson instance.
 
@@ -56,24 +66,132 @@ class ResultsExtractor:
             fields (list, optional): The fields to extract. If None, the extractor will decide what names to use. 
                 Defaults to None.
             verbose (bool, optional): Whether to print debug messages. Defaults to False.
+            max_history_tokens (int, optional): The maximum number of tokens of interactions history to consider. Longer 
+                histories are truncated, keeping the most recent interactions. If None, the whole history is used. Defaults to 4096.
         """
 
-        messages = []
+        messages = self._agent_extraction_messages(tinyperson, extraction_objective, situation, fields, fields_hints, max_history_tokens)
 
-        rendering_configs = {}
-        if fields is not None:
-            rendering_configs["fields"] = ", ".join(fields)
+        next_message = openai_utils.client().send_message(messages, temperature=0.0)
         
-        if fields_hints is not None:
-            rendering_configs["fields_hints"] = list(fields_hints.items())
+        result = self._extraction_result(next_message, verbose)
         
-        messages.append({"role": "system", 
-                         "content": chevron.render(
-                             open(self._extraction_prompt_template_path).read(), 
-                             rendering_configs)})
+        # cache the result
+        self.agent_extraction[tinyperson.name] = result
+
+        return result
+
+    def extract_results_from_agents(self, 
+                        tinypersons:List[TinyPerson], 
+                        extraction_objective:str="The main points present in the agent's interactions history.", 
+                        situation:str = "", 
+                        fields:list=None,
+                        fields_hints:dict=None,
+                        verbose:bool=False,
+                        max_history_tokens:int=4096):
+        """
+        Extracts results from several TinyPerson instances at once, like extract_results_from_agent() does for each of them.
+        All the extraction requests are submitted together through the OpenAI Batch API, which costs less but can take
+        a long time (up to 24 hours) to complete. This is meant for bulk, offline analyses.
+
+        Args:
+            tinypersons (List[TinyPerson]): The TinyPerson instances to extract results from.
+            extraction_objective (str): The extraction objective.
+            situation (str): The situation to consider.
+            fields (list, optional): The fields to extract. If None, the extractor will decide what names to use. 
+                Defaults to None.
+            verbose (bool, optional): Whether to print debug messages. Defaults to False.
+            max_history_tokens (int, optional): The maximum number of tokens of interactions history to consider. Longer 
+                histories are truncated, keeping the most recent interactions. If None, the whole history is used. Defaults to 4096.
+
+        Returns:
+            list: The results extracted from each TinyPerson, in the same order.
+        """
+
+        list_of_messages = [self._agent_extraction_messages(tinyperson, extraction_objective, situation, fields, fields_hints, max_history_tokens) 
+                            for tinyperson in tinypersons]
+
+        next_messages = openai_utils.client().send_messages_batch(list_of_messages, temperature=0.0)
+
+        results = []
+        for tinyperson, next_message in zip(tinypersons, next_messages):
+            result = self._extraction_result(next_message, verbose)
+
+            # cache the result
+            self.agent_extraction[tinyperson.name] = result
+            results.append(result)
+
+        return results
+
+    async def extract_results_from_agents_async(self, 
+                        tinypersons:List[TinyPerson], 
+                        extraction_objective:str="The main points present in the agent's interactions history.", 
+                        situation:str = "", 
+                        fields:list=None,
+                        fields_hints:dict=None,
+                        verbose:bool=False,
+                        max_concurrency:int=16,
+                        max_history_tokens:int=4096):
+        """
+        Extracts results from several TinyPerson instances concurrently, like extract_results_from_agent() does for each of them,
+        with up to max_concurrency model calls in flight at the same time.
+
+        Args:
+            tinypersons (List[TinyPerson]): The TinyPerson instances to extract results from.
+            extraction_objective (str): The extraction objective.
+            situation (str): The situation to consider.
+            fields (list, optional): The fields to extract. If None, the extractor will decide what names to use. 
+                Defaults to None.
+            verbose (bool, optional): Whether to print debug messages. Defaults to False.
+            max_concurrency (int, optional): The maximum number of concurrent model calls. Defaults to 16.
+            max_history_tokens (int, optional): The maximum number of tokens of interactions history to consider. Longer 
+                histories are truncated, keeping the most recent interactions. If None, the whole history is used. Defaults to 4096.
+
+        Returns:
+            list: The results extracted from each TinyPerson, in the same order.
+        """
+
+        # prompts are built upfront, so that only the model calls run concurrently
+        list_of_messages = [self._agent_extraction_messages(tinyperson, extraction_objective, situation, fields, fields_hints, max_history_tokens) 
+                            for tinyperson in tinypersons]
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def aux_extract(messages):
+            async with semaphore:
+                return await openai_utils.client().send_message_async(messages, temperature=0.0)
+
+        next_messages = await asyncio.gather(*[aux_extract(messages) for messages in list_of_messages])
+
+        results = []
+        for tinyperson, next_message in zip(tinypersons, next_messages):
+            result = self._extraction_result(next_message, verbose)
 
+            # cache the result
+            self.agent_extraction[tinyperson.name] = result
+            results.append(result)
 
-        interaction_history = tinyperson.pretty_current_interactions(max_content_length=None)
+        return results
+
+    def _agent_extraction_messages(self, 
+                                   tinyperson:TinyPerson, 
+                                   extraction_objective:str, 
+                                   situation:str, 
+                                   fields:list=None, 
+                                   fields_hints:dict=None,
+                                   max_history_tokens:int=4096) -> list:
+        """
+        Builds the messages to ask the LLM to extract results from a TinyPerson instance.
+        """
+
+        messages = []
+
+        messages.append(self._extraction_system_message(fields, fields_hints))
+
+
+        interaction_history = utils.compress_interactions(tinyperson.pretty_current_interactions(max_content_length=None), 
+                                                          model=openai_utils.default["model"], 
+                                                          max_tokens=max_history_tokens)
 
         extraction_request_prompt = \
 f"""
@@ -94,22 +212,47 @@ performed.
 """
         messages.append({"role": "user", "content": extraction_request_prompt})
 
-        next_message = openai_utils.client().send_message(messages, temperature=0.0)
+        return messages
+
+    def _extraction_system_message(self, fields:list=None, fields_hints:dict=None) -> dict:
+        """
+        Returns the system message for an extraction with the specified fields, rendering it only the first time.
+        All the variable content of an extraction goes in the user message instead.
+        """
+        if fields is None and fields_hints is None:
+            return dict(self._system_message_no_fields)
         
+        key = (tuple(fields) if fields is not None else None, 
+               tuple(fields_hints.items()) if fields_hints is not None else None)
+        
+        if key not in self._system_messages_with_fields:
+            rendering_configs = {}
+            if fields is not None:
+                rendering_configs["fields"] = ", ".join(fields)
+            
+            if fields_hints is not None:
+                rendering_configs["fields_hints"] = list(fields_hints.items())
+            
+            self._system_messages_with_fields[key] = {"role": "system", 
+                                                      "content": chevron.render(
+                                                          self._extraction_prompt_template, 
+                                                          rendering_configs)}
+        
+        return dict(self._system_messages_with_fields[key])
+
+    def _extraction_result(self, next_message, verbose:bool=False):
+        """
+        Extracts the results from the model response to an extraction request, if any.
+        """
         debug_msg = f"Extraction raw result message: {next_message}"
         logger.debug(debug_msg)
         if verbose:
             print(debug_msg)
 
         if next_message is not None:
-            result = utils.extract_json(next_message["content"])
+            return utils.extract_json(next_message["content"])
         else:
-            result = None
-        
-        # cache the result
-        self.agent_extraction[tinyperson.name] = result
-
-        return result
+            return None
     
 
     def extract_results_from_world(self, 
@@ -118,7 +261,8 @@ performed.
                                    situation:str="", 
                                    fields:list=None,
                                    fields_hints:dict=None,
-                                   verbose:bool=False):
+                                   verbose:bool=False,
+                                   max_history_tokens:int=4096):
         """
         Extracts results from a TinyWorld instance.
 
@@ -129,24 +273,18 @@ performed.
             fields (list, optional): The fields to extract. If None, the extractor will decide what names to use. 
                 Defaults to None.
             verbose (bool, optional): Whether to print debug messages. Defaults to False.
+            max_history_tokens (int, optional): The maximum number of tokens of interactions history to consider. Longer 
+                histories are truncated, keeping the most recent interactions. If None, the whole history is used. Defaults to 4096.
         """
 
         messages = []
 
-        rendering_configs = {}
-        if fields is not None:
-            rendering_configs["fields"] = ", ".join(fields)
-        
-        if fields_hints is not None:
-            rendering_configs["fields_hints"] = list(fields_hints.items())
-        
-        messages.append({"role": "system", 
-                         "content": chevron.render(
-                             open(self._extraction_prompt_template_path).read(), 
-                             rendering_configs)})
+        messages.append(self._extraction_system_message(fields, fields_hints))
 
         # TODO: either summarize first or break up into multiple tasks
-        interaction_history = tinyworld.pretty_current_interactions(max_content_length=None)
+        interaction_history = utils.compress_interactions(tinyworld.pretty_current_interactions(max_content_length=None), 
+                                                          model=openai_utils.default["model"], 
+                                                          max_tokens=max_history_tokens)
 
         extraction_request_prompt = \
 f"""
@@ -169,15 +307,7 @@ Each interaction history includes stimuli the corresponding agent received as we
 
         next_message = openai_utils.client().send_message(messages, temperature=0.0)
         
-        debug_msg = f"Extraction raw result message: {next_message}"
-        logger.debug(debug_msg)
-        if verbose:
-            print(debug_msg)
-
-        if next_message is not None:
-            result = utils.extract_json(next_message["content"])
-        else:
-            result = None
+        result = self._extraction_result(next_message, verbose)
         
         # cache the result
         self.world_extraction[tinyworld.name] = result
@@ -209,47 +339,90 @@ class ResultsReducer:
         self.rules = {}
     
     def add_reduction_rule(self, trigger: str, func: callable):
+        """
+        Adds a rule to reduce events of the specified type. The rule is called with the keyword arguments `focus_agent`, 
+        `source_agent`, `target_agent`, `kind`, `event`, `content` and `timestamp`, and should return either a dict 
+        mapping column names to values (preferred), a tuple of values, or None to skip the event.
+        """
         if trigger in self.rules:
             raise Exception(f"Rule for {trigger} already exists.")
         
         self.rules[trigger] = func
     
     def reduce_agent(self, agent: TinyPerson) -> list:
-        reduction = []
+        return list(self._reduce_agent_events(agent))
+
+    def reduce_agent_to_dataframe(self, agent: TinyPerson, column_names: list=None) -> pd.DataFrame:
+        columns = {}
+        rows = []
+        n_rows = 0
+        for extracted in self._reduce_agent_events(agent):
+            if isinstance(extracted, dict):
+                # column-wise accumulation, so that pandas doesn't have to reorganize the data row by row
+                for key, value in extracted.items():
+                    if key not in columns:
+                        columns[key] = [None] * n_rows
+                    columns[key].append(value)
+                n_rows += 1
+                for column in columns.values():
+                    if len(column) < n_rows:
+                        column.append(None)
+            else:
+                rows.append(extracted)
+
+        if rows:
+            # legacy rules return tuples, and the column names must then be given explicitly
+            if columns:
+                raise ValueError("Reduction rules must either all return dicts or all return tuples.")
+            return pd.DataFrame(rows, columns=column_names)
+        
+        return pd.DataFrame(columns, columns=column_names)
+
+    def _reduce_agent_events(self, agent: TinyPerson):
+        rules = self.rules
+
+        # the same few agents are referred to over and over in the memory, so we look each of them up only once
+        agents_by_name = {}
+        def get_agent(name):
+            if name not in agents_by_name:
+                agents_by_name[name] = TinyPerson.get_agent_by_name(name)
+            return agents_by_name[name]
+
         for message in agent.episodic_memory.retrieve_all():
             if message['role'] == 'system':
                 continue # doing nothing for `system` role yet at least
 
             elif message['role'] == 'user':
-                # User role is related to stimuli only
-                stimulus_type = message['content']['stimuli'][0]['type']
-                stimulus_content = message['content']['stimuli'][0]['content']
-                stimulus_source = message['content']['stimuli'][0]['source']
-                stimulus_timestamp = message['simulation_timestamp']
-
-                if stimulus_type in self.rules:
-                    extracted = self.rules[stimulus_type](focus_agent=agent, source_agent=TinyPerson.get_agent_by_name(stimulus_source), target_agent=agent, kind='stimulus', event=stimulus_type, content=stimulus_content, timestamp=stimulus_timestamp)
+                # User role is related to stimuli only. There can be several of them (e.g., batched messages).
+                for stimulus in message['content']['stimuli']:
+                    stimulus_type = stimulus['type']
+                    rule = rules.get(stimulus_type)
+                    if rule is None:
+                        continue
+
+                    stimulus_content = stimulus['content']
+                    stimulus_source = stimulus['source']
+                    stimulus_timestamp = message['simulation_timestamp']
+
+                    extracted = rule(focus_agent=agent, source_agent=get_agent(stimulus_source), target_agent=agent, kind='stimulus', event=stimulus_type, content=stimulus_content, timestamp=stimulus_timestamp)
                     if extracted is not None:
-                        reduction.append(extracted)
+                        yield extracted
 
             elif message['role'] == 'assistant':
                 # Assistant role is related to actions only
                 if 'action' in message['content']: 
                     action_type = message['content']['action']['type']
+                    rule = rules.get(action_type)
+                    if rule is None:
+                        continue
+
                     action_content = message['content']['action']['content']
                     action_target = message['content']['action']['target']
                     action_timestamp = message['simulation_timestamp']
                     
-                    if action_type in self.rules:
-                        extracted = self.rules[action_type](focus_agent=agent, source_agent=agent, target_agent=TinyPerson.get_agent_by_name(action_target), kind='action', event=action_type, content=action_content, timestamp=action_timestamp)
-                        if extracted is not None:
-                            reduction.append(extracted)
-            
-        return reduction
-
-    def reduce_agent_to_dataframe(self, agent: TinyPerson, column_names: list=None) -> pd.DataFrame:
-        reduction = self.reduce_agent(agent)
-        return pd.DataFrame(reduction, columns=column_names)
+                    extracted = rule(focus_agent=agent, source_agent=agent, target_agent=get_agent(action_target), kind='action', event=action_type, content=action_content, timestamp=action_timestamp)
+                    if extracted is not None:
+                        yield extracted
 
 
 class ArtifactExporter(JsonSerializableRegistry):
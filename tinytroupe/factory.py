@@ -3,13 +3,62 @@ import json
 import chevron
 import logging
 import copy
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 logger = logging.getLogger("tinytroupe")
 
 from tinytroupe import openai_utils
 from tinytroupe.agent import TinyPerson
 import tinytroupe.utils as utils
+import tinytroupe.control as control
 from tinytroupe.control import transactional
 
+class _JsonArrayItemsParser:
+    """
+    Incrementally parses the items of a JSON array that arrives in pieces (e.g., streamed from an LLM), returning each item 
+    as soon as it is complete. Any text before the opening bracket is ignored.
+    """
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._position = None # where the next item starts, once the opening bracket is found
+
+    def feed(self, text:str) -> list:
+        """
+        Adds more text to the array being parsed, and returns the items completed by it.
+        """
+        self._buffer += text
+        items = []
+
+        if self._position is None:
+            start = self._buffer.find("[")
+            if start == -1:
+                return items
+            self._position = start + 1
+
+        while True:
+            # skip separators
+            while self._position < len(self._buffer) and self._buffer[self._position] in " \t\r\n,":
+                self._position += 1
+
+            if self._position >= len(self._buffer) or self._buffer[self._position] == "]":
+                return items
+
+            try:
+                item, end = self._decoder.raw_decode(self._buffer, self._position)
+            except json.JSONDecodeError:
+                return items # the item is not complete yet
+
+            # a number or literal at the very end might still continue in the next piece
+            if end == len(self._buffer) and not isinstance(item, (str, dict, list)):
+                return items
+
+            items.append(item)
+            self._position = end
+
+
 class TinyFactory:
     """
     A base class for various types of factories. This is important because it makes it easier to extend the system, particularly 
@@ -100,6 +149,7 @@ class TinyPersonFactory(TinyFactory):
         """
         super().__init__(simulation_id)
         self.person_prompt_template_path = os.path.join(os.path.dirname(__file__), 'prompts/generate_person.mustache')
+        self.person_batch_prompt_template_path = os.path.join(os.path.dirname(__file__), 'prompts/generate_person_batch.mustache')
         self.context_text = context_text
         self.generated_minibios = [] # keep track of the generated persons. We keep the minibio to avoid generating the same person twice.
         self.generated_names = []
@@ -119,17 +169,7 @@ class TinyPersonFactory(TinyFactory):
         
         logger.info(f"Starting the generation of the {number_of_factories} person factories based on that context: {generic_context_text}")
         
-        system_prompt = open(os.path.join(os.path.dirname(__file__), 'prompts/generate_person_factory.md')).read()
-
-        messages = []
-        messages.append({"role": "system", "content": system_prompt})
-
-        user_prompt = chevron.render("Please, create {{number_of_factories}} person descriptions based on the following broad context: {{context}}", {
-            "number_of_factories": number_of_factories,
-            "context": generic_context_text
-        })
-
-        messages.append({"role": "user", "content": user_prompt})
+        messages = TinyPersonFactory._person_factories_generation_messages(number_of_factories, generic_context_text)
 
         response = openai_utils.client().send_message(messages)
 
@@ -145,6 +185,86 @@ class TinyPersonFactory(TinyFactory):
 
         return None
 
+    @staticmethod
+    async def generate_persons_from_factories_async(number_of_factories, generic_context_text, agent_particularities:str=None, temperature:float=1.5, attempts:int=5, max_concurrency:int=8):
+        """
+        Generate person factories like generate_person_factories() does, and then one TinyPerson instance from each of them, 
+        overlapping both stages: the descriptions of the factories are streamed from the LLM, and the generation of each person 
+        starts as soon as the description of its factory is complete, while the remaining descriptions are still being generated.
+
+        Within a started simulation, the factories and persons are generated one at a time instead, since each model call must 
+        go through the transaction cache in a reproducible order.
+
+        Args:
+            number_of_factories (int): The number of TinyPersonFactory instances (and thus of persons) to generate.
+            generic_context_text (str): The generic context text used to generate the TinyPersonFactory instances.
+            agent_particularities (str): The particularities of the agents.
+            temperature (float): The temperature to use when sampling persons from the LLM.
+            attempts (int): The maximum number of attempts to generate each person.
+            max_concurrency (int): The maximum number of concurrent person generations.
+
+        Returns:
+            list: The person generated from each factory, with None in place of those that could not be generated.
+        """
+        simulation = control.current_simulation()
+        if simulation is not None and simulation.status == control.Simulation.STATUS_STARTED:
+            factories = TinyPersonFactory.generate_person_factories(number_of_factories, generic_context_text)
+            if factories is None:
+                return None
+            return [factory.generate_person(agent_particularities, temperature, attempts) for factory in factories]
+
+        logger.info(f"Starting the streamed generation of the {number_of_factories} person factories based on that context: {generic_context_text}")
+
+        messages = TinyPersonFactory._person_factories_generation_messages(number_of_factories, generic_context_text)
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+        tasks = []
+
+        async def aux_generate(factory):
+            async with semaphore:
+                persons = await factory.generate_persons_async(1, agent_particularities, temperature, attempts)
+                return persons[0]
+
+        def aux_start(description):
+            if len(tasks) < number_of_factories:
+                logger.debug(f"Generating person factory with description: {description}")
+                tasks.append(asyncio.create_task(aux_generate(TinyPersonFactory(description))))
+
+        parser = _JsonArrayItemsParser()
+        pieces = []
+        async for piece in openai_utils.client().send_message_stream(messages):
+            pieces.append(piece)
+            for description in parser.feed(piece):
+                aux_start(description)
+
+        # in case the streamed array could not be followed (e.g., it was malformed), we fall back to parsing the whole response
+        if len(tasks) < number_of_factories:
+            result = utils.extract_json("".join(pieces))
+            if isinstance(result, list):
+                for description in result[len(tasks):]:
+                    aux_start(description)
+
+        return list(await asyncio.gather(*tasks))
+
+    @staticmethod
+    def _person_factories_generation_messages(number_of_factories, generic_context_text) -> list:
+        """
+        Builds the messages to ask the LLM for the descriptions of the specified number of person factories.
+        """
+        system_prompt = utils.read_prompt_template(os.path.join(os.path.dirname(__file__), 'prompts/generate_person_factory.md'))
+
+        messages = []
+        messages.append({"role": "system", "content": system_prompt})
+
+        user_prompt = chevron.render("Please, create {{number_of_factories}} person descriptions based on the following broad context: {{context}}", {
+            "number_of_factories": number_of_factories,
+            "context": generic_context_text
+        })
+
+        messages.append({"role": "user", "content": user_prompt})
+
+        return messages
+
     def generate_person(self, agent_particularities:str=None, temperature:float=1.5, attepmpts:int=5):
         """
         Generate a TinyPerson instance using OpenAI's LLM.
@@ -159,31 +279,13 @@ class TinyPersonFactory(TinyFactory):
 
         logger.info(f"Starting the person generation based on that context: {self.context_text}")
 
-        prompt = chevron.render(open(self.person_prompt_template_path).read(), {
-            "context": self.context_text,
-            "agent_particularities": agent_particularities,
-            "already_generated": [minibio for minibio in self.generated_minibios]
-        })
+        messages = self._person_generation_messages(agent_particularities)
 
         def aux_generate():
-
-            messages = []
-            messages += [{"role": "system", "content": "You are a system that generates specifications of artificial entities."},
-                        {"role": "user", "content": prompt}]
-
             # due to a technicality, we need to call an auxiliary method to be able to use the transactional decorator.
             message = self._aux_model_call(messages=messages, temperature=temperature)
 
-            if message is not None:
-                result = utils.extract_json(message["content"])
-
-                logger.debug(f"Generated person parameters:\n{json.dumps(result, indent=4, sort_keys=True)}")
-
-                # only accept the generated spec if the name is not already in the generated names, because they must be unique.
-                if result["name"].lower() not in self.generated_names:
-                    return result
-
-            return None # no suitable agent was generated
+            return self._accept_person_spec(message)
         
         agent_spec = None
         attempt = 0
@@ -198,24 +300,234 @@ class TinyPersonFactory(TinyFactory):
         if agent_spec is not None:
             # the agent is created here. This is why the present method cannot be cached. Instead, an auxiliary method is used
             # for the actual model call, so that it gets cached properly without skipping the agent creation.
-            person = TinyPerson(agent_spec["name"])
-            self._setup_agent(person, agent_spec["_configuration"])
-            self.generated_minibios.append(person.minibio())
-            self.generated_names.append(person.get("name").lower())
-            return person
+            return self._create_person(agent_spec)
         else:
             logger.error(f"Could not generate an agent after {attepmpts} attempts.")
             return None
+
+    def generate_persons(self, count:int, agent_particularities:str=None, temperature:float=1.5, attempts:int=5, max_workers:int=8):
+        """
+        Generate several TinyPerson instances using OpenAI's LLM, with up to max_workers model calls in flight at the same time,
+        each in its own thread. This is the synchronous counterpart of generate_persons_async(), for callers that do not use asyncio.
+
+        Within a started simulation, the persons are generated one at a time instead, since each model call must go through the
+        transaction cache in a reproducible order.
+
+        Args:
+            count (int): The number of persons to generate.
+            agent_particularities (str): The particularities of the agents.
+            temperature (float): The temperature to use when sampling from the LLM.
+            attempts (int): The maximum number of attempts to generate each person.
+            max_workers (int): The maximum number of concurrent model calls.
+
+        Returns:
+            list: The generated TinyPerson instances, with None in place of those that could not be generated.
+        """
+        simulation = control.current_simulation()
+        if simulation is not None and simulation.status == control.Simulation.STATUS_STARTED:
+            return [self.generate_person(agent_particularities, temperature, attempts) for _ in range(count)]
+
+        logger.info(f"Starting the generation of {count} persons based on that context: {self.context_text}")
+
+        # only the model calls run concurrently; building the prompt and accepting the result are serialized, 
+        # so that each generation sees the persons generated by the others so far
+        lock = threading.Lock()
+
+        def aux_generate():
+            for attempt in range(attempts):
+                try:
+                    with lock:
+                        messages = self._person_generation_messages(agent_particularities)
+
+                    message = openai_utils.client().send_message(messages, temperature=temperature)
+
+                    with lock:
+                        agent_spec = self._accept_person_spec(message)
+                        if agent_spec is not None:
+                            return self._create_person(agent_spec)
+
+                except Exception as e:
+                    logger.error(f"Error while generating agent specification: {e}")
+
+            logger.error(f"Could not generate an agent after {attempts} attempts.")
+            return None
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(aux_generate) for _ in range(count)]
+            return [future.result() for future in futures]
+
+    async def generate_persons_async(self, count:int, agent_particularities:str=None, temperature:float=1.5, attempts:int=5, max_concurrency:int=8):
+        """
+        Generate several TinyPerson instances using OpenAI's LLM, with up to max_concurrency model calls in flight at the same time.
+
+        Within a started simulation, the persons are generated one at a time instead, since each model call must go through the
+        transaction cache in a reproducible order.
+
+        Args:
+            count (int): The number of persons to generate.
+            agent_particularities (str): The particularities of the agents.
+            temperature (float): The temperature to use when sampling from the LLM.
+            attempts (int): The maximum number of attempts to generate each person.
+            max_concurrency (int): The maximum number of concurrent model calls.
+
+        Returns:
+            list: The generated TinyPerson instances, with None in place of those that could not be generated.
+        """
+        simulation = control.current_simulation()
+        if simulation is not None and simulation.status == control.Simulation.STATUS_STARTED:
+            return [self.generate_person(agent_particularities, temperature, attempts) for _ in range(count)]
+
+        logger.info(f"Starting the generation of {count} persons based on that context: {self.context_text}")
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def aux_generate():
+            async with semaphore:
+                for attempt in range(attempts):
+                    try:
+                        # the prompt is built right before each call, so that it includes the persons generated concurrently so far
+                        messages = self._person_generation_messages(agent_particularities)
+                        message = await openai_utils.client().send_message_async(messages, temperature=temperature)
+
+                        # accepting and creating the person happen without awaiting, so no other generation can interleave 
+                        agent_spec = self._accept_person_spec(message)
+                        if agent_spec is not None:
+                            return self._create_person(agent_spec)
+
+                    except Exception as e:
+                        logger.error(f"Error while generating agent specification: {e}")
+
+                logger.error(f"Could not generate an agent after {attempts} attempts.")
+                return None
+
+        return list(await asyncio.gather(*[aux_generate() for _ in range(count)]))
+
+    def generate_persons_batched(self, count:int, batch_size:int=5, agent_particularities:str=None, temperature:float=1.5, attempts:int=5):
+        """
+        Generate several TinyPerson instances using OpenAI's LLM, asking for up to batch_size persons in each model call. 
+        This pays for the prompt and the round-trip once per batch, instead of once per person.
+
+        Args:
+            count (int): The number of persons to generate.
+            batch_size (int): The maximum number of persons to ask for in each model call.
+            agent_particularities (str): The particularities of the agents.
+            temperature (float): The temperature to use when sampling from the LLM.
+            attempts (int): The maximum number of model calls that can fail to produce any new person before giving up.
+
+        Returns:
+            list: The generated TinyPerson instances. There might be fewer than count of them, if the attempts run out.
+        """
+        logger.info(f"Starting the generation of {count} persons, in batches of {batch_size}, based on that context: {self.context_text}")
+
+        persons = []
+        failed_attempts = 0
+        while len(persons) < count and failed_attempts < attempts:
+            current_batch_size = min(batch_size, count - len(persons))
+            new_persons = []
+
+            try:
+                messages = self._person_batch_generation_messages(current_batch_size, agent_particularities)
+
+                # the response must fit all the persons of the batch
+                message = self._aux_model_call(messages=messages, temperature=temperature, 
+                                               max_tokens=openai_utils.default["max_tokens"] * current_batch_size)
+
+                agent_specs = utils.extract_json(message["content"]) if message is not None else []
+                if not isinstance(agent_specs, list):
+                    agent_specs = [agent_specs] # the model might return a single person anyway
+
+                for agent_spec in agent_specs[:current_batch_size]:
+                    if self._is_acceptable_person_spec(agent_spec):
+                        new_persons.append(self._create_person(agent_spec))
+
+            except Exception as e:
+                logger.error(f"Error while generating agent specifications: {e}")
+
+            if len(new_persons) == 0:
+                failed_attempts += 1
+            persons += new_persons
+
+        if len(persons) < count:
+            logger.error(f"Could only generate {len(persons)} of {count} agents after {failed_attempts} failed attempts.")
+
+        return persons
+
+    def _person_batch_generation_messages(self, batch_size:int, agent_particularities:str=None) -> list:
+        """
+        Builds the messages to ask the LLM for batch_size new person specifications at once, taking into account the persons 
+        generated so far.
+        """
+        prompt = chevron.render(utils.read_prompt_template(self.person_batch_prompt_template_path), {
+            "batch_size": batch_size,
+            "context": self.context_text,
+            "agent_particularities": agent_particularities,
+            "already_generated": [minibio for minibio in self.generated_minibios]
+        })
+
+        return [{"role": "system", "content": "You are a system that generates specifications of artificial entities."},
+                {"role": "user", "content": prompt}]
+
+    def _person_generation_messages(self, agent_particularities:str=None) -> list:
+        """
+        Builds the messages to ask the LLM for a new person specification, taking into account the persons generated so far.
+        """
+        prompt = chevron.render(utils.read_prompt_template(self.person_prompt_template_path), {
+            "context": self.context_text,
+            "agent_particularities": agent_particularities,
+            "already_generated": [minibio for minibio in self.generated_minibios]
+        })
+
+        return [{"role": "system", "content": "You are a system that generates specifications of artificial entities."},
+                {"role": "user", "content": prompt}]
+
+    def _accept_person_spec(self, message):
+        """
+        Extracts the person specification from the model response, if any. The specification is only accepted if its name
+        was not generated before, because names must be unique. Returns None if no suitable specification was found.
+        """
+        if message is not None:
+            result = utils.extract_json(message["content"])
+
+            logger.debug(f"Generated person parameters:\n{json.dumps(result, indent=4, sort_keys=True)}")
+
+            # only accept the generated spec if the name is not already in the generated names, because they must be unique.
+            if result["name"].lower() not in self.generated_names:
+                return result
+
+        return None # no suitable agent was generated
+
+    def _is_acceptable_person_spec(self, agent_spec) -> bool:
+        """
+        Checks whether a person specification taken from a batch can be used to create a new person. Besides being well-formed,
+        its name must not have been generated before (including by the other specifications of the same batch), and must not
+        belong to another existing agent.
+        """
+        if not isinstance(agent_spec, dict) or not isinstance(agent_spec.get("name"), str) or not isinstance(agent_spec.get("_configuration"), dict):
+            logger.debug(f"Ignoring malformed person specification: {agent_spec}")
+            return False
+
+        name = agent_spec["name"]
+        return (name.lower() not in self.generated_names) and (not TinyPerson.has_agent(name))
+
+    def _create_person(self, agent_spec:dict) -> TinyPerson:
+        """
+        Creates a TinyPerson from the specified specification and keeps track of it.
+        """
+        person = TinyPerson(agent_spec["name"])
+        self._setup_agent(person, agent_spec["_configuration"])
+        self.generated_minibios.append(person.minibio())
+        self.generated_names.append(person.get("name").lower())
+        return person
         
     
     @transactional
-    def _aux_model_call(self, messages, temperature):
+    def _aux_model_call(self, messages, temperature, max_tokens=openai_utils.default["max_tokens"]):
         """
         Auxiliary method to make a model call. This is needed in order to be able to use the transactional decorator,
         due too a technicality - otherwise, the agent creation would be skipped during cache reutilization, and
         we don't want that.
         """
-        return openai_utils.client().send_message(messages, temperature=temperature)
+        return openai_utils.client().send_message(messages, temperature=temperature, max_tokens=max_tokens)
     
     @transactional
     def _setup_agent(self, agent, configuration):
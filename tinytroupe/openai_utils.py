@@ -1,14 +1,30 @@
 import os
 import openai
-from openai import OpenAI, AzureOpenAI
+from openai import OpenAI, AzureOpenAI, DefaultHttpxClient
+import httpx
+from openai.types.chat import ChatCompletion
 import time
 import json
+import asyncio
 import pickle
+import sqlite3
+import hashlib
+import ast
+import threading
+import functools
+from concurrent.futures import Future
+import zlib
 import logging
 import configparser
 import tiktoken
+import math
 from tinytroupe import utils
 
+try:
+    import zstandard # optional, compresses the API cache better and faster than zlib
+except ImportError:
+    zstandard = None
+
 logger = logging.getLogger("tinytroupe")
 
 # We'll use various configuration elements below
@@ -26,7 +42,7 @@ default["frequency_penalty"] = float(config["OpenAI"].get("FREQ_PENALTY", "0.0")
 default["presence_penalty"] = float(
     config["OpenAI"].get("PRESENCE_PENALTY", "0.0"))
 default["timeout"] = float(config["OpenAI"].get("TIMEOUT", "30.0"))
-default["max_attempts"] = float(config["OpenAI"].get("MAX_ATTEMPTS", "0.0"))
+default["max_attempts"] = int(config["OpenAI"].get("MAX_ATTEMPTS", "5"))
 default["waiting_time"] = float(config["OpenAI"].get("WAITING_TIME", "0.5"))
 default["exponential_backoff_factor"] = float(config["OpenAI"].get("EXPONENTIAL_BACKOFF_FACTOR", "5"))
 
@@ -35,10 +51,62 @@ default["embedding_model"] = config["OpenAI"].get("EMBEDDING_MODEL", "text-embed
 default["cache_api_calls"] = config["OpenAI"].getboolean("CACHE_API_CALLS", False)
 default["cache_file_name"] = config["OpenAI"].get("CACHE_FILE_NAME", "openai_api_cache.pickle")
 
+###########################################################################
+# Token counting
+###########################################################################
+
+# The extra tokens each message (and each name in a message) costs, by model. 
+# See https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+_MODEL_TOKEN_COSTS = {
+    "gpt-3.5-turbo-0613": (3, 1),
+    "gpt-3.5-turbo-16k-0613": (3, 1),
+    "gpt-4-0314": (3, 1),
+    "gpt-4-32k-0314": (3, 1),
+    "gpt-4-0613": (3, 1),
+    "gpt-4-32k-0613": (3, 1),
+    "gpt-3.5-turbo-0301": (4, -1), # every message follows <|start|>{role/name}\n{content}<|end|>\n, and if there's a name, the role is omitted
+}
+
+# Models that may update over time, and are thus counted as a specific snapshot, by a substring of their names.
+_MODEL_TOKEN_COSTS_ALIASES = [
+    ("gpt-3.5-turbo", "gpt-3.5-turbo-0613"),
+    ("gpt-4", "gpt-4-0613"),
+    ("ppo", "gpt-4-0613"),
+]
+
+@functools.lru_cache(maxsize=None)
+def _token_counting_model(model:str) -> str:
+    """
+    Returns the model whose token costs (see _MODEL_TOKEN_COSTS) apply to the specified model, or None if unknown.
+    """
+    if model in _MODEL_TOKEN_COSTS:
+        return model
+    
+    for substring, token_counting_model in _MODEL_TOKEN_COSTS_ALIASES:
+        if substring in model:
+            logger.debug(f"Token count: {model} may update over time. Returning num tokens assuming {token_counting_model}.")
+            return token_counting_model
+    
+    return None
+
 ###########################################################################
 # Model calling helpers
 ###########################################################################
 
+def _new_http_client() -> httpx.Client:
+    """
+    Creates the HTTP client for an API client, with a connection pool large enough for concurrent calls (e.g., agents 
+    acting in parallel, or concurrent generations). If the `h2` package is installed (pip install httpx[http2]), HTTP/2 
+    is used too, so that concurrent calls are multiplexed over fewer connections.
+    """
+    try:
+        import h2
+        http2 = True
+    except ImportError:
+        http2 = False
+
+    return DefaultHttpxClient(http2=http2, limits=httpx.Limits(max_connections=64, max_keepalive_connections=32))
+
 # TODO under development
 class LLMCall:
     """
@@ -82,11 +150,27 @@ class OpenAIClient:
     A utility class for interacting with the OpenAI API.
     """
 
+    # The endpoint that Batch API requests are addressed to.
+    BATCH_ENDPOINT = "/v1/chat/completions"
+
     def __init__(self, cache_api_calls=default["cache_api_calls"], cache_file_name=default["cache_file_name"]) -> None:
         logger.debug("Initializing OpenAIClient")
 
         # should we cache api calls and reuse them?
         self.set_api_cache(cache_api_calls, cache_file_name)
+
+        # tiktoken encodings used to count tokens, by model
+        self._encodings = {}
+
+        # the underlying API client is set up on first use, and then reused across calls
+        self.client = None
+
+        # cached model calls currently in progress, by cache key, so that concurrent identical calls are made only once
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+
+        # semantic caching is opt-in, since it trades exactness for more cache hits
+        self.set_semantic_cache(None)
     
     def set_api_cache(self, cache_api_calls, cache_file_name=default["cache_file_name"]):
         """
@@ -102,11 +186,41 @@ class OpenAIClient:
             self.api_cache = self._load_cache()
     
     
+    def set_semantic_cache(self, similarity_threshold:float=None, embedding_model:str=default["embedding_model"]):
+        """
+        Enables or disables the semantic caching of API calls. When enabled, a call that misses the (exact) API cache 
+        reuses the cached response of a previous call that only differs in the content of its last message, provided 
+        both contents are similar enough, by the cosine similarity of their embeddings. This catches near-duplicate 
+        requests (e.g., extractions over almost the same interactions history), at the cost of one embedding call per 
+        cache miss. It only has effect when API calls are cached, and the embeddings themselves are kept in memory only.
+
+        Args:
+        similarity_threshold (float): The minimum cosine similarity to reuse a response (e.g., 0.98), or None to disable semantic caching.
+        embedding_model (str): The model used to embed the messages.
+        """
+        self.semantic_similarity_threshold = similarity_threshold
+        self.semantic_embedding_model = embedding_model
+        self._semantic_cache = {} # {context_key: [(normalized_embedding, cache_key), ...]}
+    
+    def reset_client(self):
+        """
+        Discards the underlying API client, so that it is set up again from the current configuration on the next call.
+        """
+        self.client = None
+
+    def _ensure_client(self):
+        """
+        Sets up the underlying API client if that was not done yet. Reusing the same client across calls also reuses 
+        its connections, instead of opening new ones for every call.
+        """
+        if getattr(self, "client", None) is None:
+            self._setup_from_config()
+
     def _setup_from_config(self):
         """
         Sets up the OpenAI API configurations for this client.
         """
-        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=_new_http_client())
 
     def send_message(self,
                     current_messages,
@@ -151,8 +265,8 @@ class OpenAIClient:
             waiting_time = waiting_time * exponential_backoff_factor
         
 
-        # setup the OpenAI configurations for this client.
-        self._setup_from_config()
+        # setup the OpenAI configurations for this client, if not done yet.
+        self._ensure_client()
         
         # We need to adapt the parameters to the API type, so we create a dictionary with them first
         chat_api_params = {
@@ -169,15 +283,17 @@ class OpenAIClient:
         }
 
 
-        i = 0
-        while i < max_attempts:
-            try:
-                i += 1
+        # computed before any attempt, since the model call adds the model to the parameters
+        cache_key = self._cache_key(model, chat_api_params)
 
-                try:
-                    logger.debug(f"Sending messages to OpenAI API. Token count={self._count_tokens(current_messages, model)}.")
-                except NotImplementedError:
-                    logger.debug(f"Token count not implemented for model {model}.")
+        for i in range(1, max_attempts + 1):
+            try:
+                # counting tokens is only worth it if it is going to be logged
+                if logger.isEnabledFor(logging.DEBUG):
+                    try:
+                        logger.debug(f"Sending messages to OpenAI API. Token count={self._count_tokens(current_messages, model)}.")
+                    except NotImplementedError:
+                        logger.debug(f"Token count not implemented for model {model}.")
                     
                 start_time = time.monotonic()
                 logger.debug(f"Calling model with client class {self.__class__.__name__}.")
@@ -185,23 +301,34 @@ class OpenAIClient:
                 ###############################################################
                 # call the model, either from the cache or from the API
                 ###############################################################
-                cache_key = str((model, chat_api_params)) # need string to be hashable
                 if self.cache_api_calls and (cache_key in self.api_cache):
-                    response = self.api_cache[cache_key]
+                    response, semantic_cache_entry = self.api_cache[cache_key], None
                 else:
-                    logger.info(f"Waiting {waiting_time} seconds before next API request (to avoid throttling)...")
-                    time.sleep(waiting_time)
+                    response, semantic_cache_entry = self._semantic_cache_lookup(model, chat_api_params)
+
+                if response is None:
+                    def aux_model_call():
+                        logger.info(f"Waiting {waiting_time} seconds before next API request (to avoid throttling)...")
+                        time.sleep(waiting_time)
+                        
+                        response = self._raw_model_call(model, chat_api_params)
+                        if self.cache_api_calls:
+                            self.api_cache[cache_key] = response
+                            self._semantic_cache_add(semantic_cache_entry, cache_key)
+                        return response
                     
-                    response = self._raw_model_call(model, chat_api_params)
                     if self.cache_api_calls:
-                        self.api_cache[cache_key] = response
-                        self._save_cache()
+                        response = self._coalesced_model_call(cache_key, aux_model_call)
+                    else:
+                        # without caching, identical requests are meant to get independent responses
+                        response = aux_model_call()
                 
                 
-                logger.debug(f"Got response from API: {response}")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"Got response from API: {response}")
                 end_time = time.monotonic()
                 logger.debug(
-                    f"Got response in {end_time - start_time:.2f} seconds after {i + 1} attempts.")
+                    f"Got response in {end_time - start_time:.2f} seconds after {i} attempts.")
 
                 return utils.sanitize_dict(self._raw_model_response_extractor(response))
 
@@ -233,7 +360,307 @@ class OpenAIClient:
 
         logger.error(f"Failed to get response after {max_attempts} attempts.")
         return None
+
+    async def send_message_async(self, current_messages, **kwargs):
+        """
+        Sends a message to the OpenAI API like send_message(), but as a coroutine, so that several messages
+        can be sent concurrently (e.g., with asyncio.gather()). The call itself runs in a worker thread, so 
+        caching, retries and subclasses' customizations work exactly as in send_message().
+
+        Args:
+        current_messages (list): A list of dictionaries representing the conversation history.
+        kwargs: The same optional parameters accepted by send_message().
+
+        Returns:
+        A dictionary representing the generated response.
+        """
+        return await asyncio.to_thread(self.send_message, current_messages, **kwargs)
+
+    async def send_messages_concurrent(self, list_of_messages:list, max_concurrency:int=8, requests_per_minute:int=None, 
+                                       tokens_per_minute:int=None, **kwargs) -> list:
+        """
+        Sends several independent messages to the OpenAI API concurrently, as fast as the specified rate limits allow, 
+        in the manner of the OpenAI cookbook's parallel request processor. Each request is dispatched once there is a
+        free concurrency slot and enough request and token capacity left for it, the tokens of a request being estimated 
+        as its prompt tokens plus the maximum tokens of its completion.
+
+        Args:
+        list_of_messages (list): A list of conversation histories, each a list of dictionaries, to get a response for.
+        max_concurrency (int): The maximum number of requests in progress at the same time.
+        requests_per_minute (int): The maximum number of requests to dispatch per minute, or None for no limit.
+        tokens_per_minute (int): The maximum number of tokens to dispatch per minute, or None for no limit.
+        kwargs: The same optional parameters accepted by send_message(), applied to every request.
+
+        Returns:
+        A list with the response to each conversation history, in the same order, with None in place of those that failed.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+        requests_limiter = _RateLimiter(requests_per_minute) if requests_per_minute is not None else None
+        tokens_limiter = _RateLimiter(tokens_per_minute) if tokens_per_minute is not None else None
+
+        model = kwargs.get("model", default["model"])
+        max_tokens = kwargs.get("max_tokens", default["max_tokens"])
+
+        # prompt tokens can only be counted for models with known token costs, otherwise they are estimated
+        count_tokens = tokens_limiter is not None and _token_counting_model(model) is not None
+        if tokens_limiter is not None and not count_tokens:
+            logger.debug(f"Token count: model {model} is not supported, so prompt tokens are estimated from their length.")
+
+        async def aux_send(messages):
+            async with semaphore:
+                if requests_limiter is not None:
+                    await requests_limiter.acquire(1)
+                if tokens_limiter is not None:
+                    prompt_tokens = self._count_tokens(messages, model) if count_tokens else None
+                    if prompt_tokens is None:
+                        # rough estimate, about 4 characters per token
+                        prompt_tokens = sum(len(str(message.get("content", ""))) for message in messages) // 4
+                    await tokens_limiter.acquire(prompt_tokens + max_tokens)
+
+                return await self.send_message_async(messages, **kwargs)
+
+        return await asyncio.gather(*[aux_send(messages) for messages in list_of_messages])
+
+    async def send_message_stream(self,
+                                  current_messages,
+                                  model=default["model"],
+                                  temperature=default["temperature"],
+                                  max_tokens=default["max_tokens"],
+                                  top_p=default["top_p"],
+                                  frequency_penalty=default["frequency_penalty"],
+                                  presence_penalty=default["presence_penalty"],
+                                  stop=[],
+                                  timeout=default["timeout"],
+                                  max_attempts=default["max_attempts"],
+                                  waiting_time=default["waiting_time"],
+                                  exponential_backoff_factor=default["exponential_backoff_factor"],
+                                  stop_at_json=False):
+        """
+        Sends a message to the OpenAI API and streams the response back, as an async iterator over the pieces of
+        generated text, so that callers can start processing the response before it is complete.
+
+        Responses are cached like in send_message() (and under the same keys), but only once they have been fully
+        received. A cached response is yielded in a single piece. Retries only cover the opening of the stream:
+        errors in the middle of a stream are raised to the caller.
+
+        Args:
+        current_messages (list): A list of dictionaries representing the conversation history.
+        model, temperature, max_tokens, top_p, frequency_penalty, presence_penalty, stop, timeout, max_attempts,
+        waiting_time, exponential_backoff_factor: As in send_message().
+        stop_at_json (bool): Whether to stop streaming as soon as the text received so far contains a complete
+            JSON object, which is useful when only a JSON object is expected. Such truncated responses are not cached.
+
+        Returns:
+        An async iterator over the pieces of the generated text.
+        """
+
+        self._ensure_client()
+
+        # the same parameters (and thus cache keys) as send_message() uses for the same request
+        chat_api_params = {
+            "messages": current_messages,
+            "temperature": temperature,
+            "max_tokens":max_tokens,
+            "top_p": top_p,
+            "frequency_penalty": frequency_penalty,
+            "presence_penalty": presence_penalty,
+            "stop": stop,
+            "timeout": timeout,
+            "stream": False,
+            "n": 1,
+        }
+        cache_key = self._cache_key(model, chat_api_params)
+
+        if self.cache_api_calls and (cache_key in self.api_cache):
+            message = utils.sanitize_dict(self._raw_model_response_extractor(self.api_cache[cache_key]))
+            yield message["content"]
+            return
+
+        stream = None
+        for i in range(1, max_attempts + 1):
+            try:
+                stream = await asyncio.to_thread(self._raw_model_call, model, dict(chat_api_params, stream=True))
+                break
+
+            except (InvalidRequestError, openai.BadRequestError) as e:
+                logger.error(f"[{i}] Invalid request error, won't retry: {e}")
+                return
+
+            except (openai.RateLimitError, NonTerminalError) as e:
+                logger.warning(f"[{i}] Error, waiting {waiting_time} seconds and trying again: {e}")
+                await asyncio.sleep(waiting_time)
+                waiting_time = waiting_time * exponential_backoff_factor
+
+            except Exception as e:
+                logger.error(f"[{i}] Error: {e}")
+
+        if stream is None:
+            logger.error(f"Failed to open a response stream after {max_attempts} attempts.")
+            return
+
+        pieces = []
+        first_chunk = None
+        finish_reason = None
+        try:
+            while True:
+                # the client is synchronous, so each chunk is waited for in a worker thread
+                chunk = await asyncio.to_thread(next, stream, None)
+                if chunk is None:
+                    break
+
+                if first_chunk is None:
+                    first_chunk = chunk
+
+                if len(chunk.choices) == 0:
+                    continue
+
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+                piece = chunk.choices[0].delta.content
+                if piece:
+                    pieces.append(piece)
+                    yield piece
+
+                    if stop_at_json and ("}" in piece or "]" in piece) and utils.extract_json("".join(pieces)):
+                        logger.debug("Complete JSON object received, stopping the stream.")
+                        return
+        finally:
+            stream.close()
+
+        # only complete responses are cached
+        if self.cache_api_calls and first_chunk is not None:
+            self.api_cache[cache_key] = ChatCompletion.model_validate({
+                "id": first_chunk.id,
+                "object": "chat.completion",
+                "created": first_chunk.created,
+                "model": first_chunk.model,
+                "choices": [{"index": 0,
+                             "message": {"role": "assistant", "content": "".join(pieces)},
+                             "finish_reason": finish_reason or "stop"}],
+            })
+
+    def send_messages_batch(self,
+                            list_of_messages,
+                            model=default["model"],
+                            temperature=default["temperature"],
+                            max_tokens=default["max_tokens"],
+                            top_p=default["top_p"],
+                            frequency_penalty=default["frequency_penalty"],
+                            presence_penalty=default["presence_penalty"],
+                            stop=[],
+                            timeout=default["timeout"],
+                            waiting_time=default["waiting_time"],
+                            exponential_backoff_factor=default["exponential_backoff_factor"],
+                            max_waiting_time=60.0):
+        """
+        Sends several independent messages at once through the OpenAI Batch API, which is considerably cheaper than
+        sending them one by one, at the cost of a much higher latency (results can take up to 24 hours). This is
+        meant for bulk, offline work, such as extracting results from many agents after a simulation. Messages
+        found in the API cache are not sent again.
+
+        Args:
+        list_of_messages (list): A list of conversation histories, each like the current_messages of send_message().
+        model (str): The ID of the model to use for generating the responses.
+        temperature, max_tokens, top_p, frequency_penalty, presence_penalty, stop, timeout: As in send_message().
+        waiting_time (float): The initial number of seconds to wait between checks of the batch status.
+        exponential_backoff_factor (float): The factor by which the waiting time grows after each check.
+        max_waiting_time (float): The maximum number of seconds to wait between checks of the batch status.
+
+        Returns:
+        A list with a dictionary representing the generated response for each of the messages, in the same order, 
+        or None in place of the responses that could not be obtained.
+        """
+
+        self._ensure_client()
+
+        responses = [None] * len(list_of_messages)
+        cache_keys = [None] * len(list_of_messages)
+        request_lines = []
+        for i, current_messages in enumerate(list_of_messages):
+            # the same parameters (and thus cache keys) as send_message() uses for the same request
+            chat_api_params = {
+                "messages": current_messages,
+                "temperature": temperature,
+                "max_tokens":max_tokens,
+                "top_p": top_p,
+                "frequency_penalty": frequency_penalty,
+                "presence_penalty": presence_penalty,
+                "stop": stop,
+                "timeout": timeout,
+                "stream": False,
+                "n": 1,
+            }
+
+            cache_keys[i] = self._cache_key(model, chat_api_params)
+            if self.cache_api_calls and (cache_keys[i] in self.api_cache):
+                responses[i] = self.api_cache[cache_keys[i]]
+            else:
+                body = {key: value for key, value in chat_api_params.items() if key not in ["timeout", "stream"]}
+                body["model"] = model
+                request_lines.append(utils.json_dumps({"custom_id": str(i), "method": "POST", "url": self.BATCH_ENDPOINT, "body": body}))
+
+        if len(request_lines) > 0:
+            logger.info(f"Sending {len(request_lines)} requests through the Batch API.")
+
+            batch_file = self.client.files.create(file=("batch.jsonl", "\n".join(request_lines).encode("utf-8")), purpose="batch")
+            batch = self.client.batches.create(input_file_id=batch_file.id, endpoint=self.BATCH_ENDPOINT, completion_window="24h")
+
+            while batch.status not in ["completed", "failed", "expired", "cancelled"]:
+                logger.info(f"Batch {batch.id} is {batch.status}. Waiting {waiting_time} seconds before checking again...")
+                time.sleep(waiting_time)
+                waiting_time = min(waiting_time * exponential_backoff_factor, max_waiting_time)
+
+                batch = self.client.batches.retrieve(batch.id)
+
+            if batch.status != "completed":
+                logger.error(f"Batch {batch.id} finished with status {batch.status}.")
+
+            # even an incomplete batch might have some results
+            if batch.output_file_id is not None:
+                for line in self.client.files.content(batch.output_file_id).text.splitlines():
+                    record = utils.json_loads(line)
+                    i = int(record["custom_id"])
+                    if record.get("error") is None and record["response"]["status_code"] == 200:
+                        responses[i] = ChatCompletion.model_validate(record["response"]["body"])
+                        if self.cache_api_calls:
+                            self.api_cache[cache_keys[i]] = responses[i]
+                    else:
+                        logger.error(f"Batch request {i} failed: {record.get('error') or record['response']}")
+
+        return [utils.sanitize_dict(self._raw_model_response_extractor(response)) if response is not None else None 
+                for response in responses]
     
+    def _coalesced_model_call(self, cache_key, model_call):
+        """
+        Makes the specified model call, unless an identical one (i.e., with the same cache key) is already in progress 
+        in another thread, in which case that call's outcome is waited for and shared instead. This way, concurrent
+        identical requests (e.g., from parallel extractions) cost a single API call, like sequential ones do thanks to the cache.
+        """
+        with self._in_flight_lock:
+            future = self._in_flight.get(cache_key)
+            is_first = future is None
+            if is_first:
+                future = Future()
+                self._in_flight[cache_key] = future
+        
+        if not is_first:
+            logger.debug("Waiting for an identical model call already in progress.")
+            return future.result()
+        
+        try:
+            response = model_call()
+            future.set_result(response)
+            return response
+        
+        except BaseException as e:
+            # the other callers get the same error, and then handle it (e.g., retry) on their own
+            future.set_exception(e)
+            raise
+        
+        finally:
+            # by now the response is in the cache, where later callers will find it
+            with self._in_flight_lock:
+                del self._in_flight[cache_key]
+
     def _raw_model_call(self, model, chat_api_params):
         """
         Calls the OpenAI API with the given parameters. Subclasses should
@@ -263,34 +690,23 @@ class OpenAIClient:
         model (str): The name of the model to use for encoding the string.
         """
         try:
-            try:
-                encoding = tiktoken.encoding_for_model(model)
-            except KeyError:
-                logger.debug("Token count: model not found. Using cl100k_base encoding.")
-                encoding = tiktoken.get_encoding("cl100k_base")
-            if model in {
-                "gpt-3.5-turbo-0613",
-                "gpt-3.5-turbo-16k-0613",
-                "gpt-4-0314",
-                "gpt-4-32k-0314",
-                "gpt-4-0613",
-                "gpt-4-32k-0613",
-                }:
-                tokens_per_message = 3
-                tokens_per_name = 1
-            elif model == "gpt-3.5-turbo-0301":
-                tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-                tokens_per_name = -1  # if there's a name, the role is omitted
-            elif "gpt-3.5-turbo" in model:
-                logger.debug("Token count: gpt-3.5-turbo may update over time. Returning num tokens assuming gpt-3.5-turbo-0613.")
-                return self._count_tokens(messages, model="gpt-3.5-turbo-0613")
-            elif ("gpt-4" in model) or ("ppo" in model):
-                logger.debug("Token count: gpt-4 may update over time. Returning num tokens assuming gpt-4-0613.")
-                return self._count_tokens(messages, model="gpt-4-0613")
-            else:
+            token_counting_model = _token_counting_model(model)
+            if token_counting_model is None:
                 raise NotImplementedError(
                     f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
                 )
+            tokens_per_message, tokens_per_name = _MODEL_TOKEN_COSTS[token_counting_model]
+
+            encoding = self._encodings.get(token_counting_model)
+            if encoding is None:
+                try:
+                    encoding = tiktoken.encoding_for_model(token_counting_model)
+                except KeyError:
+                    logger.debug("Token count: model not found. Using cl100k_base encoding.")
+                    encoding = tiktoken.get_encoding("cl100k_base")
+
+                self._encodings[token_counting_model] = encoding
+
             num_tokens = 0
             for message in messages:
                 num_tokens += tokens_per_message
@@ -305,22 +721,93 @@ class OpenAIClient:
             logger.error(f"Error counting tokens: {e}")
             return None
 
-    def _save_cache(self):
+    def _semantic_cache_lookup(self, model, chat_api_params):
         """
-        Saves the API cache to disk. We use pickle to do that because some obj
-        are not JSON serializable.
+        Looks up the semantic cache for a response to the specified call. 
+
+        Returns:
+        A (response, entry) pair. The response is None if no similar enough call was cached, and the entry is what
+        must be passed to _semantic_cache_add() to cache the call afterwards (None if semantic caching is disabled).
         """
-        # use pickle to save the cache
-        pickle.dump(self.api_cache, open(self.cache_file_name, "wb"))
+        if not self.cache_api_calls or self.semantic_similarity_threshold is None:
+            return None, None
+
+        messages = chat_api_params["messages"]
+        content = messages[-1]["content"]
+
+        # only calls that are the same except for the content of their last message can be matched
+        context_params = {key: value for key, value in chat_api_params.items() if key != "model"}
+        context_params["messages"] = messages[:-1] + [{**messages[-1], "content": None}]
+        context_key = self._cache_key(model, context_params)
+
+        try:
+            embedding = self.get_embedding(content, model=self.semantic_embedding_model)
+            norm = math.sqrt(sum(x * x for x in embedding))
+            embedding = [x / norm for x in embedding]
+        except Exception as e:
+            logger.warning(f"Could not embed message for semantic caching, skipping it: {e}")
+            return None, None
+
+        best_similarity, best_cache_key = -1.0, None
+        for cached_embedding, cached_key in self._semantic_cache.get(context_key, []):
+            similarity = sum(x * y for x, y in zip(embedding, cached_embedding))
+            if similarity > best_similarity:
+                best_similarity, best_cache_key = similarity, cached_key
+
+        if best_cache_key is not None and best_similarity >= self.semantic_similarity_threshold and best_cache_key in self.api_cache:
+            logger.debug(f"Reusing semantically cached response (similarity={best_similarity:.4f}).")
+            return self.api_cache[best_cache_key], None
+
+        return None, (context_key, embedding)
+
+    def _semantic_cache_add(self, entry, cache_key):
+        """
+        Adds a call, previously looked up with _semantic_cache_lookup(), to the semantic cache.
+        """
+        if entry is not None:
+            context_key, embedding = entry
+            self._semantic_cache.setdefault(context_key, []).append((embedding, cache_key))
+
+    @staticmethod
+    def _cache_key(model, chat_api_params) -> str:
+        """
+        Computes the API cache key for a model call, as a fixed-size digest of its canonical JSON representation. 
+        This keeps keys small and fast to look up, no matter how long the messages are.
+        """
+        blob = utils.json_dumps({"m": model, "p": chat_api_params}, sort_keys=True).encode("utf-8")
+        return hashlib.blake2b(blob, digest_size=16).hexdigest()
 
-    
     def _load_cache(self):
 
         """
-        Loads the API cache from disk.
+        Opens the API cache on disk. Caches saved by older versions as a single pickle are migrated to the current format,
+        keeping the original file with a .bak suffix.
         """
-        # unpickle
-        return pickle.load(open(self.cache_file_name, "rb")) if os.path.exists(self.cache_file_name) else {}
+        legacy_cache = None
+        if os.path.exists(self.cache_file_name) and not ApiCache.is_cache_file(self.cache_file_name):
+            logger.info(f"Migrating API cache {self.cache_file_name} to the current format.")
+            with open(self.cache_file_name, "rb") as f:
+                legacy_cache = pickle.load(f)
+            os.replace(self.cache_file_name, self.cache_file_name + ".bak")
+
+        cache = ApiCache(self.cache_file_name)
+
+        if legacy_cache:
+            # the oldest caches are keyed by the string representation of (model, chat_api_params), so they are re-keyed to be reused
+            migrated_cache = {}
+            for key, response in legacy_cache.items():
+                if key.startswith("("):
+                    try:
+                        model, chat_api_params = ast.literal_eval(key)
+                        key = self._cache_key(model, chat_api_params)
+                    except (ValueError, SyntaxError):
+                        logger.debug(f"Could not migrate API cache key, it will not be reused: {key[:100]}")
+
+                migrated_cache[key] = response
+
+            cache.update(migrated_cache)
+
+        return cache
 
     def get_embedding(self, text, model=default["embedding_model"]):
         """
@@ -333,6 +820,8 @@ class OpenAIClient:
         Returns:
         The embedding of the text.
         """
+        self._ensure_client()
+
         response = self._raw_embedding_model_call(text, model)
         return self._raw_embedding_model_response_extractor(response)
     
@@ -355,6 +844,9 @@ class OpenAIClient:
 
 class AzureClient(OpenAIClient):
 
+    # Azure OpenAI Service addresses batch requests to deployments without the API version prefix.
+    BATCH_ENDPOINT = "/chat/completions"
+
     def __init__(self, cache_api_calls=default["cache_api_calls"], cache_file_name=default["cache_file_name"]) -> None:
         logger.debug("Initializing AzureClient")
 
@@ -367,7 +859,8 @@ class AzureClient(OpenAIClient):
         """
         self.client = AzureOpenAI(azure_endpoint= os.getenv("AZURE_OPENAI_ENDPOINT"),
                                   api_version = config["OpenAI"]["AZURE_API_VERSION"],
-                                  api_key = os.getenv("AZURE_OPENAI_KEY"))
+                                  api_key = os.getenv("AZURE_OPENAI_KEY"),
+                                  http_client=_new_http_client())
     
     def _raw_model_call(self, model, chat_api_params):
         """
@@ -380,6 +873,142 @@ class AzureClient(OpenAIClient):
                 )
 
 
+class ApiCache:
+    """
+    A persistent cache of API responses, backed by SQLite. Each response is written on its own as soon as it is added, 
+    instead of rewriting the whole cache, and the cache can be safely shared by concurrent calls and processes.
+    Supports the dict operations used by the clients: `in`, `[]` and `update()`.
+
+    Responses are stored compressed, with zstd if the `zstandard` package is installed, or zlib otherwise. The first 
+    byte of each stored value tells its format, so caches remain readable as formats are added.
+    """
+
+    # formats of the stored values, given by their first byte
+    FORMAT_PICKLE = 0
+    FORMAT_PICKLE_ZLIB = 1
+    FORMAT_PICKLE_ZSTD = 2
+
+    def __init__(self, file_name:str):
+        self.file_name = file_name
+
+        # a single connection (and zstd context) is shared by all threads (e.g., agents acting in parallel), so its use is serialized
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(file_name, isolation_level=None, check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS cache(k TEXT PRIMARY KEY, v BLOB)")
+
+        if zstandard is not None:
+            self._zstd_compressor = zstandard.ZstdCompressor(level=3)
+            self._zstd_decompressor = zstandard.ZstdDecompressor()
+
+    @staticmethod
+    def is_cache_file(file_name:str) -> bool:
+        """
+        Checks whether the specified file is an API cache in the current (SQLite) format. Empty files are valid SQLite databases.
+        """
+        with open(file_name, "rb") as f:
+            return f.read(16) in [b"", b"SQLite format 3\x00"]
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return self._connection.execute("SELECT 1 FROM cache WHERE k = ?", (key,)).fetchone() is not None
+
+    def __getitem__(self, key):
+        with self._lock:
+            row = self._connection.execute("SELECT v FROM cache WHERE k = ?", (key,)).fetchone()
+            if row is None:
+                raise KeyError(key)
+
+            return self._decode(row[0])
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO cache(k, v) VALUES (?, ?)", (key, self._encode(value)))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def update(self, items:dict):
+        """
+        Adds several responses at once, in a single transaction.
+        """
+        with self._lock:
+            rows = [(key, self._encode(value)) for key, value in items.items()]
+
+            self._connection.execute("BEGIN")
+            try:
+                self._connection.executemany("INSERT OR REPLACE INTO cache(k, v) VALUES (?, ?)", rows)
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    def _encode(self, value) -> bytes:
+        # pickle is used because some responses are not JSON serializable
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+        if zstandard is not None:
+            value_format, compressed = ApiCache.FORMAT_PICKLE_ZSTD, self._zstd_compressor.compress(data)
+        else:
+            value_format, compressed = ApiCache.FORMAT_PICKLE_ZLIB, zlib.compress(data)
+
+        # very small values might not get any smaller
+        if len(compressed) < len(data):
+            return bytes([value_format]) + compressed
+        else:
+            return bytes([ApiCache.FORMAT_PICKLE]) + data
+
+    def _decode(self, blob:bytes):
+        value_format, data = blob[0], blob[1:]
+
+        if value_format == ApiCache.FORMAT_PICKLE:
+            return pickle.loads(data)
+        elif value_format == ApiCache.FORMAT_PICKLE_ZLIB:
+            return pickle.loads(zlib.decompress(data))
+        elif value_format == ApiCache.FORMAT_PICKLE_ZSTD:
+            if zstandard is None:
+                raise ValueError("This API cache entry is compressed with zstd, which requires the zstandard package (pip install zstandard).")
+            return pickle.loads(self._zstd_decompressor.decompress(data))
+        elif blob[:1] == b"\x80":
+            # uncompressed values from before formats were recorded (pickles start with the PROTO opcode)
+            return pickle.loads(blob)
+        else:
+            raise ValueError(f"Unknown API cache entry format: {value_format}.")
+
+
+class _RateLimiter:
+    """
+    A token bucket limiting how much of some capacity (e.g., requests or tokens) can be used per minute, for concurrent
+    coroutines. The bucket starts full and refills continuously.
+    """
+
+    def __init__(self, capacity_per_minute:float):
+        self.capacity = capacity_per_minute
+        self.available = capacity_per_minute
+        self.last_update = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount:float):
+        """
+        Waits until the specified amount of capacity is available, and then uses it. Amounts larger than the whole 
+        capacity are allowed once the bucket is full, so that they are not blocked forever.
+        """
+        amount = min(amount, self.capacity)
+
+        # callers are served one at a time, in order, so that large amounts are not starved by small ones
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.available = min(self.capacity, self.available + (now - self.last_update) * self.capacity / 60.0)
+                self.last_update = now
+
+                if self.available >= amount:
+                    self.available -= amount
+                    return
+
+                await asyncio.sleep((amount - self.available) * 60.0 / self.capacity)
+
+
 class InvalidRequestError(Exception):
     """
     Exception raised when the request to the OpenAI API is invalid.
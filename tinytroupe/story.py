@@ -3,15 +3,26 @@ Every simulation tells a story. This module provides helper mechanisms to help w
 """
 
 from typing import List
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import logging
 from tinytroupe.agent import TinyPerson
 from tinytroupe.environment import TinyWorld
 import tinytroupe.utils as utils
 from tinytroupe import openai_utils
 
+logger = logging.getLogger("tinytroupe")
+
+# The story pieces generated so far in this process, by request, with the most recently used last. See TinyStory.cache_generations.
+_story_generations_cache = OrderedDict()
+_story_generations_cache_lock = threading.Lock()
+_STORY_GENERATIONS_CACHE_MAX_SIZE = 256
+
 class TinyStory:
 
     def __init__(self, environment:TinyWorld=None, agent:TinyPerson=None, purpose:str="Be a realistic simulation.", context:str="",
-                 first_n=10, last_n=20, include_omission_info:bool=True) -> None:
+                 first_n=10, last_n=20, include_omission_info:bool=True, cache_generations:bool=False) -> None:
         """
         Initialize the story. The story can be about an environment or an agent. It also has a purpose, which
         is used to guide the story generation. Stories are aware that they are related to simulations, so one can
@@ -25,6 +36,9 @@ class TinyStory:
             first_n (int, optional): The number of first interactions to include in the story. Defaults to 10.
             last_n (int, optional): The number of last interactions to include in the story. Defaults to 20.
             include_omission_info (bool, optional): Whether to include information about omitted interactions. Defaults to True.
+            cache_generations (bool, optional): Whether to reuse the story pieces generated before (by any story in this process) 
+                for identical requests, instead of calling the model again. This is useful when iterating on the same story, 
+                but it means identical requests no longer get different pieces. Defaults to False.
         """
         
         # exactly one of these must be provided
@@ -43,6 +57,8 @@ class TinyStory:
         self.first_n = first_n
         self.last_n = last_n
         self.include_omission_info = include_omission_info
+
+        self.cache_generations = cache_generations
     
     def start_story(self, requirements="Start some interesting story about the agents.", number_of_words:int=100, include_plot_twist:bool=False) -> str:
         """
@@ -57,10 +73,7 @@ class TinyStory:
                              "include_plot_twist": include_plot_twist
                             }
 
-        messages = utils.compose_initial_LLM_messages_with_templates("story.start.system.mustache", "story.start.user.mustache", rendering_configs)
-        next_message = openai_utils.client().send_message(messages, temperature=1.5)
-
-        start = next_message["content"]
+        start = self._generate("story.start.system.mustache", "story.start.user.mustache", rendering_configs, temperature=1.5)
 
         self.current_story += utils.dedent(\
             f"""
@@ -87,10 +100,7 @@ class TinyStory:
                              "include_plot_twist": include_plot_twist
                             }
 
-        messages = utils.compose_initial_LLM_messages_with_templates("story.continuation.system.mustache", "story.continuation.user.mustache", rendering_configs)
-        next_message = openai_utils.client().send_message(messages, temperature=1.5)
-
-        continuation = next_message["content"]
+        continuation = self._generate("story.continuation.system.mustache", "story.continuation.user.mustache", rendering_configs, temperature=1.5)
 
         self.current_story += utils.dedent(\
             f"""
@@ -104,6 +114,145 @@ class TinyStory:
 
         return continuation
 
+    def continue_story_batch(self, variants:List[dict]) -> List[str]:
+        """
+        Propose several alternative continuations of the story at once, one for each of the specified variants, with all the
+        model calls made concurrently instead of one after the other. Each variant is a dict with any of the arguments of 
+        continue_story() (i.e., `requirements`, `number_of_words` and `include_plot_twist`), the missing ones taking their 
+        default values. Since these are alternatives, none of them is added to the story.
+
+        Args:
+            variants (List[dict]): The variants to generate continuations for.
+
+        Returns:
+            List[str]: The proposed continuations, in the same order as the variants.
+        """
+        # all variants continue from the same point of the story
+        current_simulation_trace = self._current_story()
+
+        def aux_continue(variant):
+            rendering_configs = self._continuation_rendering_configs(variant, current_simulation_trace)
+            return self._generate("story.continuation.system.mustache", "story.continuation.user.mustache", rendering_configs, temperature=1.5)
+
+        if len(variants) == 0:
+            return []
+
+        with ThreadPoolExecutor(max_workers=len(variants)) as executor:
+            return list(executor.map(aux_continue, variants))
+
+    async def continue_story_many(self, variants:List[dict], max_concurrency:int=8, requests_per_minute:int=None, tokens_per_minute:int=None) -> List[str]:
+        """
+        Propose several alternative continuations of the story like continue_story_batch() does, but as a coroutine, 
+        scheduling the model calls so that they respect the specified rate limits (see OpenAIClient.send_messages_concurrent()). 
+        This is the better choice for large numbers of variants. Contrary to continue_story_batch(), a failed model call does 
+        not raise an error, so that the other continuations are not lost: the failed variants just get None.
+
+        Args:
+            variants (List[dict]): The variants to generate continuations for.
+            max_concurrency (int): The maximum number of model calls in progress at the same time.
+            requests_per_minute (int): The maximum number of model calls to start per minute, or None for no limit.
+            tokens_per_minute (int): The maximum number of tokens to use per minute, or None for no limit.
+
+        Returns:
+            List[str]: The proposed continuations, in the same order as the variants, with None for those that failed.
+        """
+        # all variants continue from the same point of the story
+        current_simulation_trace = self._current_story()
+
+        system_template_name = "story.continuation.system.mustache"
+        user_template_name = "story.continuation.user.mustache"
+        temperature = 1.5
+
+        list_of_rendering_configs = [self._continuation_rendering_configs(variant, current_simulation_trace) for variant in variants]
+        keys = [self._generation_key(system_template_name, user_template_name, rendering_configs, temperature) 
+                for rendering_configs in list_of_rendering_configs]
+        continuations = [self._cached_generation(key) for key in keys]
+
+        # only what is not cached yet goes to the model
+        missing = [i for i, continuation in enumerate(continuations) if continuation is None]
+        list_of_messages = [utils.compose_initial_LLM_messages_with_templates(system_template_name, user_template_name, list_of_rendering_configs[i]) 
+                            for i in missing]
+        next_messages = await openai_utils.client().send_messages_concurrent(list_of_messages, 
+                                                                             max_concurrency=max_concurrency, 
+                                                                             requests_per_minute=requests_per_minute, 
+                                                                             tokens_per_minute=tokens_per_minute,
+                                                                             temperature=temperature)
+        for i, next_message in zip(missing, next_messages):
+            if next_message is None:
+                logger.error(f"Failed to generate a continuation for the story variant {variants[i]}.")
+                continue
+
+            continuations[i] = next_message["content"]
+            self._cache_generation(keys[i], continuations[i])
+
+        return continuations
+
+    def _continuation_rendering_configs(self, variant:dict, current_simulation_trace:str) -> dict:
+        """
+        Builds the rendering configurations to continue the story according to the specified variant (see continue_story_batch()).
+        """
+        return {
+                "purpose": self.purpose,
+                "requirements": variant.get("requirements", "Continue the story in an interesting way."),
+                "current_simulation_trace": current_simulation_trace,
+                "number_of_words": variant.get("number_of_words", 100),
+                "include_plot_twist": variant.get("include_plot_twist", False)
+               }
+
+    def _generate(self, system_template_name:str, user_template_name:str, rendering_configs:dict, temperature:float) -> str:
+        """
+        Generates a piece of the story with the specified templates, reusing a previous generation for the same request if 
+        generations are cached.
+        """
+        key = self._generation_key(system_template_name, user_template_name, rendering_configs, temperature)
+        content = self._cached_generation(key)
+        if content is not None:
+            return content
+
+        # The templates leave everything that varies between requests (requirements, length, etc.) to the end of the prompt,
+        # after the story so far, which only grows by appending. So successive requests share a long prompt prefix, which
+        # the provider can cache instead of processing the whole story again.
+        messages = utils.compose_initial_LLM_messages_with_templates(system_template_name, user_template_name, rendering_configs)
+        next_message = openai_utils.client().send_message(messages, temperature=temperature)
+        if next_message is None:
+            raise Exception(f"Failed to generate a story piece with templates {system_template_name} and {user_template_name}: the model call failed.")
+
+        content = next_message["content"]
+        self._cache_generation(key, content)
+
+        return content
+
+    def _generation_key(self, system_template_name:str, user_template_name:str, rendering_configs:dict, temperature:float) -> str:
+        """
+        Returns the key of the specified request in the generations cache, or None if generations are not cached.
+        """
+        if not self.cache_generations:
+            return None
+        return utils.custom_hash((system_template_name, user_template_name, utils.json_dumps(rendering_configs, sort_keys=True), temperature))
+
+    def _cached_generation(self, key:str) -> str:
+        """
+        Returns the cached generation with the specified key, or None if there is none.
+        """
+        if key is None:
+            return None
+        with _story_generations_cache_lock:
+            if key in _story_generations_cache:
+                _story_generations_cache.move_to_end(key)
+                return _story_generations_cache[key]
+        return None
+
+    def _cache_generation(self, key:str, content:str):
+        """
+        Caches the specified generation under the specified key, unless generations are not cached (i.e., the key is None).
+        """
+        if key is None:
+            return
+        with _story_generations_cache_lock:
+            _story_generations_cache[key] = content
+            if len(_story_generations_cache) > _STORY_GENERATIONS_CACHE_MAX_SIZE:
+                _story_generations_cache.popitem(last=False)
+
     def _current_story(self) -> str:
         """
         Get the current story.
@@ -1,7 +1,6 @@
 """
 General utilities and convenience functions.
 """
-import re
 import json
 import os
 import sys
@@ -9,17 +8,37 @@ import hashlib
 import textwrap
 import logging
 import chevron
+import chevron.tokenizer
 import copy
+import functools
+import itertools
+import random
+import time
+import tiktoken
 from typing import Collection
 from datetime import datetime
 from pathlib import Path
 import configparser
 from typing import Any, TypeVar, Union
+
+try:
+    import orjson # optional, but considerably faster than the standard json module
+except ImportError:
+    orjson = None
+
+try:
+    import xxhash # optional, but much faster than hashlib for the non-cryptographic hashes needed here
+except ImportError:
+    xxhash = None
+
 AgentOrWorld = Union["TinyPerson", "TinyWorld"]
 
 # logger
 logger = logging.getLogger("tinytroupe")
 
+# where the prompt templates are
+_PROMPTS_DIR = Path(__file__).parent / "prompts"
+
 
 ################################################################################
 # Model input utilities
@@ -32,46 +51,135 @@ def compose_initial_LLM_messages_with_templates(system_template_name:str, user_t
     These messages are composed using the specified templates and rendering configurations.
     """
 
-    system_prompt_template_path = os.path.join(os.path.dirname(__file__), f'prompts/{system_template_name}')
-    user_prompt_template_path = os.path.join(os.path.dirname(__file__), f'prompts/{user_template_name}')
-
     messages = []
 
     messages.append({"role": "system", 
-                         "content": chevron.render(
-                             open(system_prompt_template_path).read(), 
-                             rendering_configs)})
+                         "content": _render_template(system_template_name, rendering_configs)})
     
     # optionally add a user message
     if user_template_name is not None:
         messages.append({"role": "user", 
-                            "content": chevron.render(
-                                    open(user_prompt_template_path).read(), 
-                                    rendering_configs)})
+                            "content": _render_template(user_template_name, rendering_configs)})
     return messages
 
+def _render_template(template_name:str, rendering_configs:dict) -> str:
+    """
+    Renders the specified prompt template, which is parsed only the first time.
+    """
+    return chevron.render(_load_template_tokens(template_name), rendering_configs)
+
+@functools.lru_cache(maxsize=64)
+def _load_template_tokens(template_name:str) -> tuple:
+    # chevron renders a sequence of tokens directly, without parsing the template again
+    return tuple(chevron.tokenizer.tokenize(_load_template(template_name)))
+
+@functools.lru_cache(maxsize=64)
+def _load_template(template_name:str) -> str:
+    """
+    Reads the specified prompt template only once, since templates are used over and over in model calls.
+    """
+    return read_prompt_template(_PROMPTS_DIR / template_name)
+
+@functools.lru_cache(maxsize=64)
+def read_prompt_template(path:Union[str, Path]) -> str:
+    """
+    Reads the prompt template at the specified path only once, since templates are used over and over in model calls.
+    """
+    return Path(path).read_text(encoding="utf-8")
+
+
+def compress_interactions(text: str, model: str, max_tokens: int=4096, method: str="truncate") -> str:
+    """
+    Compresses a (possibly very long) interactions history so that it fits within the specified token budget, 
+    to keep prompts short, cheap and fast. Texts that already fit are returned unchanged.
+
+    Args:
+        text (str): The interactions history to compress.
+        model (str): The model the text is meant for, used to choose the tokenizer.
+        max_tokens (int, optional): The token budget. If None, the text is returned as is. Defaults to 4096.
+        method (str, optional): How to compress the text. "truncate" keeps only the most recent tokens, while 
+            "llmlingua" prunes the less informative tokens throughout the text using the `llmlingua` package, 
+            which must then be installed. Defaults to "truncate".
+    
+    Returns:
+        str: The compressed text.
+    """
+    # a token always spans at least one byte, so short enough texts need not even be tokenized
+    if max_tokens is None or len(text) * 4 <= max_tokens:
+        return text
+    
+    encoding = _encoding_for_model(model)
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    
+    logger.debug(f"Compressing interactions history from {len(tokens)} to {max_tokens} tokens using method '{method}'.")
+
+    if method == "truncate":
+        # the most recent interactions are the most relevant ones, so we keep the tail of the history,
+        # starting at a line boundary if possible
+        tail = encoding.decode(tokens[-max_tokens:])
+        first_line_end = tail.find("\n")
+        if first_line_end != -1:
+            tail = tail[first_line_end + 1:]
+        return "(...)\n" + tail
+    
+    elif method == "llmlingua":
+        return _llmlingua_compressor().compress_prompt(text, target_token=max_tokens)["compressed_prompt"]
+    
+    else:
+        raise ValueError(f"Unknown compression method: {method}")
+
+@functools.lru_cache(maxsize=None)
+def _encoding_for_model(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        logger.debug(f"No specific tokenizer found for model {model}. Using cl100k_base encoding.")
+        return tiktoken.get_encoding("cl100k_base")
+
+@functools.lru_cache(maxsize=None)
+def _llmlingua_compressor():
+    try:
+        from llmlingua import PromptCompressor
+    except ImportError as e:
+        raise ImportError("The 'llmlingua' compression method requires the llmlingua package (pip install llmlingua).") from e
+    
+    # loading the compression model is expensive, so it is done only once
+    return PromptCompressor()
+
 
 ################################################################################	
 # Model output utilities
 ################################################################################
+
+_json_decoder = json.JSONDecoder()
+
 def extract_json(text: str) -> dict:
     """
     Extracts a JSON object from a string, ignoring: any text before the first 
     opening curly brace; and any Markdown opening (```json) or closing(```) tags.
     """
     try:
-        # remove any text before the first opening curly or square braces, using regex. Leave the braces.
-        text = re.sub(r'^.*?({|\[)', r'\1', text, flags=re.DOTALL)
-
-        # remove any trailing text after the LAST closing curly or square braces, using regex. Leave the braces.
-        text  =  re.sub(r'(}|\])(?!.*(\]|\})).*$', r'\1', text, flags=re.DOTALL)
+        # remove any text before the first opening curly or square braces. Leave the braces.
+        # Plain scans are used instead of regexes, which backtrack badly on long outputs.
+        start = min((i for i in (text.find('{'), text.find('[')) if i >= 0), default=0)
+        
+        # remove any trailing text after the LAST closing curly or square braces. Leave the braces.
+        end = max(text.rfind('}'), text.rfind(']'))
+        text = text[start:end + 1] if end >= start else text[start:]
         
-        # remove invalid escape sequences, which show up sometimes
-        # replace \' with just '
-        text =  re.sub("\\'", "'", text) #re.sub(r'\\\'', r"'", text)
-
         # return the parsed JSON object
-        return json.loads(text)
+        try:
+            return json_loads(text)
+        
+        except ValueError:
+            # remove invalid escape sequences, which show up sometimes
+            # replace \' with just '
+            text = text.replace("\\'", "'")
+
+            # parse just the first JSON value, in case the trailing text has braces too
+            return _json_decoder.raw_decode(text)[0]
     
     except Exception:
         return {}
@@ -82,11 +190,15 @@ def extract_code_block(text: str) -> str:
     opening triple backticks and any text after the closing triple backticks.
     """
     try:
-        # remove any text before the first opening triple backticks, using regex. Leave the backticks.
-        text = re.sub(r'^.*?(```)', r'\1', text, flags=re.DOTALL)
-
-        # remove any trailing text after the LAST closing triple backticks, using regex. Leave the backticks.
-        text  =  re.sub(r'(```)(?!.*```).*$', r'\1', text, flags=re.DOTALL)
+        # remove any text before the first opening triple backticks. Leave the backticks.
+        start = text.find("```")
+        if start > 0:
+            text = text[start:]
+
+        # remove any trailing text after the LAST closing triple backticks. Leave the backticks.
+        end = text.rfind("```")
+        if end >= 0:
+            text = text[:end + 3]
         
         return text
     
@@ -97,30 +209,65 @@ def extract_code_block(text: str) -> str:
 # Model control utilities
 ################################################################################    
 
-def repeat_on_error(retries:int, exceptions:list):
+def repeat_on_error(retries:int, exceptions:list, waiting_time:float=0.0, exponential_backoff_factor:float=2.0, 
+                    max_waiting_time:float=30.0, timeout:float=None):
     """
     Decorator that repeats the specified function call if an exception among those specified occurs, 
     up to the specified number of retries. If that number of retries is exceeded, the
     exception is raised. If no exception occurs, the function returns normally.
 
+    Retries can be delayed with an exponential backoff, so that transient errors (e.g., rate limits) get time to clear.
+    The waiting times are randomized a bit, so that concurrent callers do not all retry at the same time. If the 
+    exception carries a Retry-After header (as the API's rate limit errors do), that time is waited instead.
+
     Args:
         retries (int): The number of retries to attempt.
         exceptions (list): The list of exception classes to catch.
+        waiting_time (float): The time to wait before the first retry, in seconds. Defaults to 0, i.e., retry immediately.
+        exponential_backoff_factor (float): The factor by which the waiting time grows after each retry.
+        max_waiting_time (float): The maximum time to wait before a retry, in seconds.
+        timeout (float): The maximum time to keep retrying for, in seconds since the first call, or None for no limit.
     """
+    exceptions = tuple(exceptions)
+
     def decorator(func):
         def wrapper(*args, **kwargs):
+            deadline = time.monotonic() + timeout if timeout is not None else None
             for i in range(retries):
                 try:
                     return func(*args, **kwargs)
-                except tuple(exceptions) as e:
+                except exceptions as e:
                     logger.debug(f"Exception occurred: {e}")
                     if i == retries - 1:
                         raise e
-                    else:
-                        logger.debug(f"Retrying ({i+1}/{retries})...")
-                        continue
+                    
+                    delay = _retry_after(e)
+                    if delay is None:
+                        delay = min(max_waiting_time, waiting_time * exponential_backoff_factor ** i) * random.uniform(0.5, 1.5)
+                    
+                    if deadline is not None and time.monotonic() + delay > deadline:
+                        logger.debug("No time left to retry.")
+                        raise e
+
+                    logger.debug(f"Retrying ({i+1}/{retries}) in {delay:.2f} seconds...")
+                    if delay > 0:
+                        time.sleep(delay)
         return wrapper
     return decorator
+
+def _retry_after(exception:Exception) -> float:
+    """
+    Returns the time to wait before retrying that is requested by the specified exception (i.e., the Retry-After header 
+    of its HTTP response, if any), in seconds, or None if there is none.
+    """
+    headers = getattr(getattr(exception, "response", None), "headers", None)
+    if headers is None:
+        return None
+    
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
    
 
 ################################################################################
@@ -189,17 +336,11 @@ def add_rai_template_variables_if_enabled(template_variables: dict) -> dict:
         "RAI_COPYRIGHT_INFRINGEMENT_PREVENTION", True
     )
 
-    # Harmful content
-    with open(os.path.join(os.path.dirname(__file__), "prompts/rai_harmful_content_prevention.md"), "r") as f:
-        rai_harmful_content_prevention_content = f.read()
-
-    template_variables['rai_harmful_content_prevention'] = rai_harmful_content_prevention_content if rai_harmful_content_prevention else None
+    # Harmful content (the disclaimer files are read only once, and only if needed)
+    template_variables['rai_harmful_content_prevention'] = _load_template("rai_harmful_content_prevention.md") if rai_harmful_content_prevention else None
 
     # Copyright infringement
-    with open(os.path.join(os.path.dirname(__file__), "prompts/rai_copyright_infringement_prevention.md"), "r") as f:
-        rai_copyright_infringement_prevention_content = f.read()
-
-    template_variables['rai_copyright_infringement_prevention'] = rai_copyright_infringement_prevention_content if rai_copyright_infringement_prevention else None
+    template_variables['rai_copyright_infringement_prevention'] = _load_template("rai_copyright_infringement_prevention.md") if rai_copyright_infringement_prevention else None
 
     return template_variables
 
@@ -222,7 +363,18 @@ def break_text_at_length(text: Union[str, dict], max_length: int=None) -> str:
     If the maximum length is `None`, the content is returned as is.
     """
     if isinstance(text, dict):
-        text = json.dumps(text, indent=4)
+        if max_length is None:
+            text = json.dumps(text, indent=4)
+        else:
+            # serialize only as much as needed to reach the break point, since the dict might be large
+            chunks = []
+            length = 0
+            for chunk in json.JSONEncoder(indent=4).iterencode(text):
+                chunks.append(chunk)
+                length += len(chunk)
+                if length > max_length:
+                    break
+            text = "".join(chunks)
 
     if max_length is None or len(text) <= max_length:
         return text
@@ -246,6 +398,29 @@ def dedent(text: str) -> str:
 ################################################################################
 _config = None
 
+_DEFAULT_CONFIG_PATH = Path(__file__).parent.absolute() / 'config.ini'
+
+# The contents of the config files parsed so far, by path, along with the modification time of the file when it was parsed
+_parsed_config_files = {}
+
+def _parsed_config_file(config_file_path:Path) -> dict:
+    """
+    Returns the (raw) values of the specified config file, by section, parsing the file only if it was not parsed 
+    before or was modified since then.
+    """
+    mtime = config_file_path.stat().st_mtime_ns
+    cached = _parsed_config_files.get(config_file_path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    parser = configparser.ConfigParser()
+    parser.read(config_file_path)
+    sections = {section: {option: parser.get(section, option, raw=True) for option in parser.options(section)} 
+                for section in parser.sections()}
+    
+    _parsed_config_files[config_file_path] = (mtime, sections)
+    return sections
+
 def read_config_file(use_cache=True, verbose=True) -> configparser.ConfigParser:
     global _config
     if use_cache and _config is not None:
@@ -256,10 +431,10 @@ def read_config_file(use_cache=True, verbose=True) -> configparser.ConfigParser:
         config = configparser.ConfigParser()
 
         # Read the default values in the module directory.
-        config_file_path = Path(__file__).parent.absolute() / 'config.ini'
+        config_file_path = _DEFAULT_CONFIG_PATH
         print(f"Looking for default config on: {config_file_path}") if verbose else None
         if config_file_path.exists():
-            config.read(config_file_path)
+            config.read_dict(_parsed_config_file(config_file_path))
             _config = config
         else:
             raise ValueError(f"Failed to find default config on: {config_file_path}")
@@ -269,7 +444,7 @@ def read_config_file(use_cache=True, verbose=True) -> configparser.ConfigParser:
         config_file_path = Path.cwd() / "config.ini"
         if config_file_path.exists():
             print(f"Found custom config on: {config_file_path}") if verbose else None
-            config.read(config_file_path) # this only overrides the values that are present in the custom config
+            config.read_dict(_parsed_config_file(config_file_path)) # this only overrides the values that are present in the custom config
             _config = config
             return config
         else:
@@ -469,6 +644,33 @@ def post_init(cls):
     cls.__init__ = new_init
     return cls
 
+################################################################################
+# JSON utilities
+################################################################################
+def json_dumps(obj, sort_keys: bool=False) -> str:
+    """
+    Serializes the specified object as compact JSON, with non-ASCII characters left as they are and any value 
+    that is not JSON serializable converted to a string. Uses `orjson` if it is installed. Apart from the notation 
+    of very large or very small floats, the result is the same either way, so it can also be used to compute keys.
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        try:
+            return orjson.dumps(obj, option=option, default=str).decode("utf-8")
+        except TypeError:
+            pass # e.g., integers that are too large, or strings that are not valid UTF-8
+    
+    return json.dumps(obj, sort_keys=sort_keys, separators=(",", ":"), ensure_ascii=False, default=str)
+
+def json_loads(text: Union[str, bytes]):
+    """
+    Parses the specified JSON text. Uses `orjson` if it is installed.
+    """
+    if orjson is not None:
+        return orjson.loads(text)
+    
+    return json.loads(text)
+
 ################################################################################
 # Other
 ################################################################################
@@ -485,16 +687,26 @@ def custom_hash(obj):
     """
     Returns a hash for the specified object. The object is first converted
     to a string, to make it hashable. This method is deterministic,
-    contrary to the built-in hash() function.
+    contrary to the built-in hash() function, though the hashes depend 
+    on whether xxhash is installed.
     """
+    data = str(obj).encode()
+    if xxhash is not None:
+        return xxhash.xxh3_128_hexdigest(data)
 
-    return hashlib.sha256(str(obj).encode()).hexdigest()
+    return hashlib.sha256(data).hexdigest()
 
-_fresh_id_counter = 0
+# next() on an itertools.count is atomic, so IDs are unique even across threads
+_fresh_id_counter = itertools.count(1)
 def fresh_id():
     """
     Returns a fresh ID for a new object. This is useful for generating unique IDs for objects.
     """
+    return next(_fresh_id_counter)
+
+def reset_fresh_id():
+    """
+    Makes fresh IDs start from 1 again.
+    """
     global _fresh_id_counter
-    _fresh_id_counter += 1
-    return _fresh_id_counter
+    _fresh_id_counter = itertools.count(1)
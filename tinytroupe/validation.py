@@ -38,8 +38,7 @@ class TinyPersonValidator:
         
         # Generating the prompt to check the person
         check_person_prompt_template_path = os.path.join(os.path.dirname(__file__), 'prompts/check_person.mustache')
-        with open(check_person_prompt_template_path, 'r') as f:
-            check_agent_prompt_template = f.read()
+        check_agent_prompt_template = utils.read_prompt_template(check_person_prompt_template_path)
         
         system_prompt = chevron.render(check_agent_prompt_template, {"expectations": expectations})
 